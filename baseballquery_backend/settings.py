@@ -140,4 +140,87 @@ REST_FRAMEWORK = {  # pyright: ignore[reportUnknownVariableType]
 }
 
 SECURE_PROXY_SSL_HEADER = ("HTTP_X_FORWARDED_PROTO", "https")
-CSRF_TRUSTED_ORIGINS = os.environ.get("CSRF_TRUSTED_ORIGINS", "http://localhost").split(" ")
\ No newline at end of file
+CSRF_TRUSTED_ORIGINS = os.environ.get("CSRF_TRUSTED_ORIGINS", "http://localhost").split(" ")
+
+# Admission control for queries that miss the cache
+# The budget is in cost units shared by all the workers on the host, where one modern season split by year costs 1
+
+ADMISSION_BUDGET = float(os.environ.get("ADMISSION_BUDGET", 10))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", 20))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 60))
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", 30))
+ADMISSION_STATE_PATH = os.environ.get("ADMISSION_STATE_PATH", "lmdb_db/admission.json")
+
+# Sort orders that cache entries store a precomputed permutation for, separated by spaces
+
+CACHE_SORT_KEYS = os.environ.get(
+    "CACHE_SORT_KEYS",
+    "year,player_id year,team -PA -HR -AVG -OPS -wOBA -wRC+ -IP -K ERA FIP WHIP",
+).split()
+
+# Leaderboards that are materialized after every data update, given as the query params a client would send.
+# Queries without years are for the latest season in the dataset.
+
+LEADERBOARDS = [
+    {"type": "batting", "query": {}},
+    {"type": "batting", "query": {"min_pa": "100"}},
+    {"type": "batting", "query": {"sort": "-PA"}},
+    {"type": "batting", "query": {"sort": "-HR"}},
+    {"type": "batting", "query": {"sort": "-OPS", "min_pa": "100"}},
+    {"type": "batting", "query": {"sort": "-wRC+", "min_pa": "100"}},
+    {"type": "pitching", "query": {}},
+    {"type": "pitching", "query": {"min_ip": "20"}},
+    {"type": "pitching", "query": {"sort": "-IP"}},
+    {"type": "pitching", "query": {"sort": "-K"}},
+    {"type": "pitching", "query": {"sort": "ERA", "min_ip": "20"}},
+    {"type": "pitching", "query": {"sort": "FIP", "min_ip": "20"}},
+]
+LEADERBOARD_PAGES = int(os.environ.get("LEADERBOARD_PAGES", 5))
+LEADERBOARD_CHECK_INTERVAL = float(os.environ.get("LEADERBOARD_CHECK_INTERVAL", 5))
+
+# Data versions and HTTP caching of stat responses
+
+DATA_VERSIONS_PATH = os.environ.get("DATA_VERSIONS_PATH", "lmdb_db/data_versions.json")
+HISTORICAL_MAX_AGE = int(os.environ.get("HISTORICAL_MAX_AGE", 60 * 60 * 24 * 30))
+CURRENT_SEASON_MAX_AGE = int(os.environ.get("CURRENT_SEASON_MAX_AGE", 0))
+
+# Compression of stat responses and of the values stored in the query cache
+
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", 5))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_MEMO_SIZE = int(os.environ.get("COMPRESSION_MEMO_SIZE", 256))
+CACHE_COMPRESSION = bool(int(os.environ.get("CACHE_COMPRESSION", 1)))
+CACHE_COMPRESSION_LEVEL = int(os.environ.get("CACHE_COMPRESSION_LEVEL", 4))
+
+# Query cache storage
+# CACHE_SHARED_URL optionally adds a shared second tier behind the local LMDB cache, either
+# "redis://[:password@]host[:port][/db]" for a Redis protocol server or "memory://" for an in-process stand-in
+
+CACHE_PATH = os.environ.get("CACHE_PATH", "lmdb_db")
+# How often workers check whether `manage.py compact_cache` made a new generation of the cache current, in seconds
+CACHE_GENERATION_CHECK_INTERVAL = float(os.environ.get("CACHE_GENERATION_CHECK_INTERVAL", 5))
+CACHE_SHARED_URL = os.environ.get("CACHE_SHARED_URL", "")
+CACHE_SHARED_TTL = int(os.environ.get("CACHE_SHARED_TTL", 60 * 60 * 24 * 30))
+CACHE_SHARED_TIMEOUT = float(os.environ.get("CACHE_SHARED_TIMEOUT", 1))
+CACHE_WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get("CACHE_WRITE_BEHIND_QUEUE_SIZE", 1000))
+# Also write computed stats to the local cache from a background thread instead of during the request
+CACHE_WRITE_BEHIND = bool(int(os.environ.get("CACHE_WRITE_BEHIND", 0)))
+
+# Per-worker cache of decoded query cache entries, bounded by an estimate of the memory the decoded rows take, which
+# is about three times the size of their JSON. Set HOT_CACHE_MAX_BYTES to 0 to disable it.
+
+HOT_CACHE_MAX_BYTES = int(os.environ.get("HOT_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+HOT_CACHE_TTL = float(os.environ.get("HOT_CACHE_TTL", 600))
+
+# Profiling of stat requests. Admins can profile a request by adding ?profile=1, and PROFILE_SAMPLE_RATE is the
+# fraction of all stat requests that are profiled. Profiles are listed and served at /api/profiles. A profile also
+# covers other requests the worker ran while the profiled one waited on I/O, which its includes_concurrent_requests
+# field says.
+
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "lmdb_db/profiles")
+PROFILE_MAX_COUNT = int(os.environ.get("PROFILE_MAX_COUNT", 100))
+
+# How often workers check whether update_new_data.py published a new dataset, in seconds
+DATASET_CHECK_INTERVAL = float(os.environ.get("DATASET_CHECK_INTERVAL", 5))
@@ -0,0 +1,94 @@
+"""
+Compares results with "NaN"/"N/A" sentinel strings in them to results that keep missing values typed.
+
+Run with: python benchmark_typed_columns.py [rows]
+"""
+import sys
+import time
+
+import msgspec.json as json
+import numpy as np
+import pandas as pd
+
+from rest_api.serialization import nullable_cols, to_records
+from rest_api.sorting import sort_stats
+
+rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+rng = np.random.default_rng(0)
+
+
+def make_stats():
+    stats = pd.DataFrame({
+        "player_id": [f"player{i:06d}" for i in range(rows)],
+        "year": rng.integers(1950, 2026, rows),
+        "team": np.nan,
+        "PA": rng.integers(0, 700, rows),
+        "HR": rng.integers(0, 60, rows),
+        "AVG": rng.random(rows),
+        "OPS": rng.random(rows) * 1.5,
+        "wRC+": rng.normal(100, 30, rows),
+    })
+    # Rate stats are missing for players without a plate appearance
+    for col in ("AVG", "OPS", "wRC+"):
+        stats.loc[stats["PA"] == 0, col] = np.nan
+    return stats
+
+
+def sentinel_stats(stats):
+    # What calculate_stats used to return
+    stats = stats.copy()
+    for col in nullable_cols:
+        if col in stats:
+            stats[col] = stats[col].fillna("N/A")
+    return stats.fillna("NaN")
+
+
+def old_sort_key(rows, field):
+    # How sort_stats used to sort numeric fields with sentinels in them
+    return sorted(rows, key=lambda x: x[field] if type(x[field]) in (int, float) else float("-inf"), reverse=True)
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    typed = make_stats()
+    sentinel = sentinel_stats(typed)
+    print(f"{rows} rows")
+
+    print("\nDataFrame memory (deep)")
+    typed_memory = typed.memory_usage(deep=True).sum()
+    sentinel_memory = sentinel.memory_usage(deep=True).sum()
+    print(f"  sentinels: {sentinel_memory / 1e6:8.1f} MB")
+    print(f"  typed:     {typed_memory / 1e6:8.1f} MB ({typed_memory / sentinel_memory:.0%})")
+    for col in ("AVG", "OPS", "wRC+"):
+        print(f"  {col} dtype: {sentinel[col].dtype} -> {typed[col].dtype}")
+
+    sentinel_rows, sentinel_time = timed(sentinel.to_dict, "records")
+    typed_rows, typed_time = timed(to_records, typed)
+    print("\nConverting to rows")
+    print(f"  sentinels: {sentinel_time * 1000:8.1f} ms")
+    print(f"  typed:     {typed_time * 1000:8.1f} ms")
+
+    print("\nEncoded size")
+    print(f"  sentinels: {len(json.encode(sentinel_rows)) / 1e6:8.1f} MB")
+    print(f"  typed:     {len(json.encode(typed_rows)) / 1e6:8.1f} MB")
+
+    print("\nSorting rows by -AVG")
+    _, sentinel_time = timed(old_sort_key, sentinel_rows, "AVG")
+    _, typed_time = timed(sort_stats, typed_rows, "-AVG")
+    print(f"  sentinels: {sentinel_time * 1000:8.1f} ms")
+    print(f"  typed:     {typed_time * 1000:8.1f} ms")
+
+    print("\nSorting the DataFrame by -AVG")
+    _, sentinel_time = timed(lambda: sentinel.sort_values("AVG", ascending=False, key=lambda s: pd.to_numeric(s, errors="coerce")))
+    _, typed_time = timed(lambda: typed.sort_values("AVG", ascending=False))
+    print(f"  sentinels: {sentinel_time * 1000:8.1f} ms")
+    print(f"  typed:     {typed_time * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 #!/bin/sh
 export LD_LIBRARY_PATH=/usr/local/lib
-python3 update_new_data.py
+# Serve from the last published dataset and cache right away, the update publishes a new dataset when it is done
+python3 update_new_data.py --full &
 exec "$@"
@@ -0,0 +1,191 @@
+import fcntl
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import msgspec.json as json
+from django.conf import settings
+from rest_framework.exceptions import APIException
+
+# Relative cost of each split compared to a plain per-year split
+split_cost = {
+    "year": 1.0,
+    "career": 1.0,
+    "month": 1.5,
+    "game": 4.0,
+}
+
+# Average number of events per game in the events table
+events_per_game = 78
+
+# Events in a modern 30 team, 162 game season, used as the unit of cost
+reference_season_events = 30 * 162 // 2 * events_per_game
+
+# How often a queued query checks whether queries in other workers finished, in seconds
+poll_interval = 0.25
+
+
+class ServiceOverloaded(APIException):
+    status_code = 503
+    default_detail = "Too many expensive queries are being computed right now, try again later."
+    default_code = "service_overloaded"
+
+    def __init__(self, wait, detail=None):
+        super().__init__(detail)
+        # DRF's exception handler turns this into a Retry-After header
+        self.wait = wait
+
+
+def season_events(year):
+    """
+    Estimates the number of events in a season from the size of the league schedule.
+
+    Args:
+        year: The season.
+
+    Returns:
+        The approximate number of rows the season contributes to the events table.
+    """
+    if year < 1961:
+        teams, games = 16, 154
+    elif year < 1969:
+        teams, games = 20, 162
+    elif year < 1977:
+        teams, games = 24, 162
+    elif year < 1993:
+        teams, games = 26, 162
+    elif year < 1998:
+        teams, games = 28, 162
+    else:
+        teams, games = 30, 162
+    if year == 2020:
+        games = 60
+    return teams * games // 2 * events_per_game
+
+
+def estimate_cost(params, years):
+    """
+    Estimates how expensive it is to compute a query that missed the cache.
+
+    Args:
+        params: The normalized query params.
+        years: The years that have to be computed.
+
+    Returns:
+        The cost of the query, where one modern season split by year costs 1.
+    """
+    events = sum(season_events(year) for year in years)
+    cost = events / reference_season_events * split_cost.get(params["split"], 1.0)
+    # Inning filters go through every game of the query one at a time
+    return cost * (1 + len(params.get("filter_stats", [])))
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class HostBudget:
+    """
+    The cost of the cold queries being computed by all the workers on the host, kept as a list of
+    [pid, reservation, cost] in a file that is locked while it is read and updated. Reservations of
+    workers that exited without releasing them are dropped.
+    """
+
+    def __init__(self, path, budget):
+        self.path = path
+        self.budget = budget
+
+    @contextmanager
+    def reservations(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a+b") as f:
+            # Only held while the list is updated
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            data = f.read()
+            reservations = [reservation for reservation in (json.decode(data) if data else []) if process_alive(reservation[0])]
+            yield reservations
+            f.seek(0)
+            f.truncate()
+            f.write(json.encode(reservations))
+
+    def reserve(self, reservation, cost):
+        """
+        Reserves cost from the budget if it fits. A query larger than the whole budget is only run on its own.
+
+        Returns:
+            Whether the cost was reserved.
+        """
+        with self.reservations() as reservations:
+            if reservations and sum(reserved for _, _, reserved in reservations) + cost > self.budget:
+                return False
+            reservations.append([os.getpid(), reservation, cost])
+            return True
+
+    def release(self, reservation):
+        with self.reservations() as reservations:
+            reservations[:] = [entry for entry in reservations if entry[:2] != [os.getpid(), reservation]]
+
+
+class AdmissionController:
+    """
+    Limits the total cost of the cold queries being computed by all the workers on the host at once.
+
+    Queries that do not fit in the budget wait in a per-worker queue ordered by cost, so cheap queries
+    are admitted first. When the queue is full or a query waits for too long it is rejected
+    with a 503 and a Retry-After header instead of tying up the worker.
+    """
+
+    def __init__(self, host, queue_size, queue_timeout, retry_after):
+        self.host = host
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.waiting = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def admit(self, cost):
+        reservation = next(self.counter)
+        with self.condition:
+            if self.waiting or not self.host.reserve(reservation, cost):
+                if len(self.waiting) >= self.queue_size:
+                    raise ServiceOverloaded(self.retry_after)
+                entry = (cost, reservation)
+                heapq.heappush(self.waiting, entry)
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while self.waiting[0] != entry or not self.host.reserve(reservation, cost):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise ServiceOverloaded(self.retry_after)
+                        # Other workers free up budget without notifying this one
+                        self.condition.wait(min(remaining, poll_interval))
+                finally:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self.condition.notify_all()
+        try:
+            yield
+        finally:
+            self.host.release(reservation)
+            with self.condition:
+                self.condition.notify_all()
+
+
+controller = AdmissionController(
+    host=HostBudget(settings.ADMISSION_STATE_PATH, settings.ADMISSION_BUDGET),
+    queue_size=settings.ADMISSION_QUEUE_SIZE,
+    queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT,
+    retry_after=settings.ADMISSION_RETRY_AFTER,
+)
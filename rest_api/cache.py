@@ -1,14 +1,83 @@
-import lmdb
+import brotli
+import time
 import msgspec.json as json
+from array import array
 from hashlib import sha1
+from django.conf import settings
+from rest_api.cache_backends import CacheEntry, LMDBBackend, TieredBackend, WriteBehindBackend, make_shared_backend
+from rest_api.compaction import current_generation
+from rest_api.hot_cache import HotCache, HotEntry
+from rest_api.serialization import to_records
+from rest_api.sorting import sort_permutation
+from rest_api.versions import get_year_versions
+
+# Values starting with this byte are brotli compressed JSON, anything else is plain JSON
+compressed_marker = b"\x01"
+
+# Part of every entry key, so entries stored in an older format are never read.
+# Format 2 stores missing values as null instead of the "NaN"/"N/A" strings, format 3 adds the player/team index,
+# format 4 stores the data version of each year an entry covers, format 5 stores the rows of each player/team in
+# the index instead of byte ranges into the entry.
+cache_format = 5
+
+# Columns whose values are indexed, so the rows of one player or team can be read without reading a whole entry
+index_cols = ["player_id", "team"]
+
+def join_rows(encoded_rows):
+    # Joins rows encoded one at a time into a JSON array
+    return b"[" + b",".join(encoded_rows) + b"]"
+
+def compress_value(data, compression_level):
+    if compression_level is None:
+        return data
+    return compressed_marker + brotli.compress(data, quality=compression_level)
+
+def decompress_value(data):
+    if data[:1] == compressed_marker:
+        return brotli.decompress(data[1:])
+    return data
 
 class QueryCache:
-    def __init__(self, db_path="lmdb_db", map_size=1024*1024*1024*1024):
-        self.env = lmdb.open(db_path, map_size=map_size, readahead=False, max_dbs=3)
-        self.calls = self.env.open_db(b"calls")
-        self.years = self.env.open_db(b"years", dupsort=True)
+    def __init__(self, db_path="lmdb_db", map_size=1024*1024*1024*1024, sort_keys=(), compression_level=None, shared=None, hot=None, write_behind=False):
+        # The local LMDB store is always the first tier, and also holds the materialized leaderboard pages.
+        # db_path can hold compacted generations of it, in which case the current one is used.
+        self.db_path = db_path
+        self.generation_path = current_generation(db_path)
+        self.generation_checked_at = time.monotonic()
+        self.local = LMDBBackend(self.generation_path, map_size)
+        self.backend = self.local if shared is None else TieredBackend(self.local, shared, settings.CACHE_WRITE_BEHIND_QUEUE_SIZE)
+        if write_behind:
+            self.backend = WriteBehindBackend(self.backend, settings.CACHE_WRITE_BEHIND_QUEUE_SIZE)
+        self.sort_keys = sort_keys
+        # Brotli quality stats are compressed with before they are stored, or None to store them uncompressed
+        self.compression_level = compression_level
+        # Optional HotCache of decoded entries in front of the backend
+        self.hot = hot
 
-    def get_data(self, params):
+    def check_generation(self):
+        # Switch to a new generation once compact_cache has made one current
+        if time.monotonic() - self.generation_checked_at < settings.CACHE_GENERATION_CHECK_INTERVAL:
+            return
+        self.generation_checked_at = time.monotonic()
+        path = current_generation(self.db_path)
+        if path != self.generation_path:
+            self.generation_path = path
+            self.local.open(path)
+
+    def entry_keys(self, params, versions=None):
+        """
+        Gets the keys of the cache entries that make up a query.
+
+        Args:
+            params: The normalized query params.
+            versions: A dict of year to data version to get the keys of the entries computed from those versions,
+                or None for the current versions.
+
+        Returns:
+            A list of (key, years covered by the entry, data version of each of those years) tuples.
+        """
+        if versions is None:
+            versions = get_year_versions(params["start_year"], params["end_year"])
         if params["split"] != "career":
             # Split the params into multiple params_dicts with year: year_value for each year in [start_year, end_year]
             keys = []
@@ -17,59 +86,251 @@ class QueryCache:
                 del params_dict["start_year"]
                 del params_dict["end_year"]
                 params_dict["year"] = year
-                h = sha1(json.encode(params_dict, order="deterministic")).digest()
-                keys.append(h)
-            data = []
-            years_found = set()
-            with self.env.begin(write=False) as txn:
-                for key in keys:
-                    h = key
-                    stats = txn.get(h, db=self.calls)
-                    if stats is not None:
-                        data.extend(json.decode(stats))
-                        year = int.from_bytes(txn.get(h, db=self.years))
-                        years_found.add(year)
-
-            return data, years_found
+                params_dict["format"] = cache_format
+                # Once a year gets new data its entries get new keys, on every node, so stale entries are never read
+                if year in versions:
+                    params_dict["version"] = versions[year]
+                keys.append((sha1(json.encode(params_dict, order="deterministic")).digest(), [year], [versions.get(year, 0)]))
+            return keys
         else:
             # For career stats, just use the original params with start_year and end_year
-            h = sha1(json.encode(params, order="deterministic")).digest()
-            with self.env.begin(write=False) as txn:
-                stats = txn.get(h, db=self.calls)
-                if stats is not None:
-                    return json.decode(stats), set(year for year in range(params["start_year"], params["end_year"] + 1))
-                else:
-                    return [], set()
-
-    def put_data(self, params, stats, years_found):
-        if params["split"] != "career":
-            # Split the params into multiple params_dicts with year: year_value for each year in [start_year, end_year]
-            for year in range(params["start_year"], params["end_year"] + 1):
-                if year in years_found:
+            params_dict = {**params, "format": cache_format}
+            if versions:
+                params_dict["versions"] = sorted(versions.items())
+            h = sha1(json.encode(params_dict, order="deterministic")).digest()
+            years = list(range(params["start_year"], params["end_year"] + 1))
+            return [(h, years, [versions.get(year, 0) for year in years])]
+
+    def get_chunks(self, params, sort=None, scope=None):
+        """
+        Gets the cached stats for a query as one list of rows per cache entry.
+
+        Args:
+            params: The normalized query params.
+            sort: If this is one of the cache's sort keys, entries are returned in this order where possible.
+            scope: A (column, value) tuple to only get the rows of one player or team, read through the index.
+
+        Returns:
+            A tuple of the non-empty lists of rows, whether each list is already sorted by sort, and the set of years found.
+        """
+        self.check_generation()
+        entries = self.entry_keys(params)
+        keys = [key for key, _, _ in entries]
+        if scope is not None:
+            rows_per_key = self.read_scoped(keys, scope)
+            # The scoped rows are only a handful per entry, so they are not worth putting in order here
+            orders = [None] * len(keys)
+        else:
+            rows_per_key, orders = self.read_entries(keys, sort if sort in self.sort_keys else None)
+
+        chunks = []
+        presorted = []
+        years_found = set()
+        for (_, years, _), rows, order in zip(entries, rows_per_key, orders):
+            if rows is None:
+                continue
+            years_found.update(years)
+            if not rows:
+                continue
+            if order is not None:
+                rows = [rows[i] for i in order]
+            chunks.append(rows)
+            presorted.append(order is not None)
+        return chunks, presorted, years_found
+
+    def get_changed_rows(self, params, since_versions):
+        """
+        Gets the cached rows of the entries of a query whose data changed since the given data versions, both as they
+        were computed from those versions and as they are now. Entries that did not change are not read.
+
+        Args:
+            params: The normalized query params.
+            since_versions: A dict of year to data version, from parse_version_token.
+
+        Returns:
+            A tuple of the old rows and the current rows, or None if any of the entries is not cached.
+        """
+        self.check_generation()
+        # Tokens from wider queries can have years the query does not cover
+        since_versions = {year: version for year, version in since_versions.items() if params["start_year"] <= year <= params["end_year"]}
+        changed = [(old_key, new_key) for (old_key, _, _), (new_key, _, _) in zip(self.entry_keys(params, since_versions), self.entry_keys(params)) if old_key != new_key]
+        rows_per_key, _ = self.read_entries([old_key for old_key, _ in changed] + [new_key for _, new_key in changed], None)
+        if any(rows is None for rows in rows_per_key):
+            return None
+        return [row for rows in rows_per_key[:len(changed)] for row in rows], [row for rows in rows_per_key[len(changed):] for row in rows]
+
+    def read_entries(self, keys, sort):
+        """
+        Reads and decodes entries, from the hot cache where they are in it.
+
+        Args:
+            keys: The entry keys.
+            sort: A sort key to also get the sort permutations of, or None.
+
+        Returns:
+            A tuple of the rows of each key (None for keys that are not cached) and the sort permutation of each key.
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            entry = self.hot.get(key) if self.hot is not None else None
+            if entry is None:
+                missing.append(key)
+            else:
+                found[key] = entry
+        if missing:
+            for key, value in zip(missing, self.backend.get_values(missing)):
+                if value is None:
                     continue
-                params_dict = params.copy()
-                del params_dict["start_year"]
-                del params_dict["end_year"]
-                params_dict["year"] = year
-                h = sha1(json.encode(params_dict, order="deterministic")).digest()
-                stats_for_year = stats[stats['year'] == year].to_dict(orient='records', index=True)
+                data = decompress_value(value)
+                found[key] = HotEntry(tuple(json.decode(data)))
+                if self.hot is not None:
+                    self.hot.put(key, found[key])
+
+        if sort is None:
+            return [found[key].rows if key in found else None for key in keys], [None] * len(keys)
+        # Permutations are read once per hot entry too
+        unsorted = [key for key in found if sort not in found[key].orders]
+        if unsorted:
+            for key, order in zip(unsorted, self.backend.get_orders(unsorted, sort)):
+                found[key].orders[sort] = None if order is None else array("I", order)
+        return [found[key].rows if key in found else None for key in keys], [found[key].orders[sort] if key in found else None for key in keys]
+
+    def read_scoped(self, keys, scope):
+        """
+        Reads the rows of one player or team from entries. Entries in the hot cache are filtered there, the others are
+        read through the index without reading the rest of the entry.
+
+        Args:
+            keys: The entry keys.
+            scope: The (column, value) of the player or team.
 
-                with self.env.begin(write=True) as txn:
-                    txn.put(h, json.encode(stats_for_year), db=self.calls)
-                    txn.put(h, year.to_bytes(2), db=self.years)
+        Returns:
+            The rows of each key, or None for keys that are not cached.
+        """
+        column, value = scope
+        found = {}
+        for key in keys:
+            entry = self.hot.get(key) if self.hot is not None else None
+            if entry is not None:
+                found[key] = [row for row in entry.rows if row.get(column) == value]
+        missing = [key for key in keys if key not in found]
+        for key, record in zip(missing, self.backend.get_index(missing, "%s:%s" % scope) if missing else []):
+            if record is not None:
+                # An empty record means the entry is cached but the player or team has no rows in it
+                found[key] = json.decode(decompress_value(record)) if record else []
+        return [found.get(key) for key in keys]
+
+    def make_entry(self, key, years, versions, rows, hot_entry=None):
+        orders = {}
+        groups = {}
+        encoded = [json.encode(row) for row in rows]
+        data = join_rows(encoded)
+        if rows:
+            for sort in self.sort_keys:
+                if all(field.lstrip("-") in rows[0] for field in sort.split(",")):
+                    orders[sort] = array("I", sort_permutation(rows, sort)).tobytes()
+            for col in index_cols:
+                if col not in rows[0]:
+                    continue
+                for row, encoded_row in zip(rows, encoded):
+                    if row[col] is not None:
+                        groups.setdefault(f"{col}:{row[col]}", []).append(encoded_row)
+        # Each player's or team's rows are stored on their own, so scoped reads only decompress those
+        index = {name: compress_value(join_rows(group), self.compression_level) for name, group in groups.items()}
+        if hot_entry is not None:
+            # Replaces any permutations requests read from the backend before the entry was written to it
+            hot_entry.orders = {sort: array("I", orders[sort]) if sort in orders else None for sort in self.sort_keys}
+        return CacheEntry(key, compress_value(data, self.compression_level), years, orders, index, versions)
+
+    def put_data(self, params, stats, years, versions=None):
+        """
+        Caches the stats computed for a query, all in one write.
+
+        Args:
+            params: The normalized query params.
+            stats: The computed stats.
+            years: The years the stats were computed for. Years without any rows are cached as empty.
+            versions: The data versions the stats were computed from, or None for the current versions.
+        """
+        self.check_generation()
+        rows = to_records(stats)
+        if params["split"] != "career":
+            # Partition the rows in one pass instead of filtering the frame once per year
+            rows_by_year = {}
+            for row in rows:
+                rows_by_year.setdefault(row["year"], []).append(row)
+            parts = [(key, entry_years, entry_versions, rows_by_year.get(entry_years[0], []))
+                     for key, entry_years, entry_versions in self.entry_keys(params, versions) if entry_years[0] in years]
         else:
-            # For career stats, just use the original params with start_year and end_year
-            h = sha1(json.encode(params, order="deterministic")).digest()
-            with self.env.begin(write=True) as txn:
-                txn.put(h, json.encode(stats.to_dict(orient='records', index=True)), db=self.calls)
-                for year in range(params["start_year"], params["end_year"] + 1):
-                    txn.put(h, year.to_bytes(2), db=self.years)
+            [(key, entry_years, entry_versions)] = self.entry_keys(params, versions)
+            parts = [(key, entry_years, entry_versions, rows)]
+        hot_entries = [None] * len(parts)
+        if self.hot is not None:
+            # Fresh results are likely to be asked for again (e.g. the next page), and with write-behind they are not
+            # in the backend yet
+            hot_entries = [HotEntry(tuple(entry_rows)) for _, _, _, entry_rows in parts]
+            for (key, _, _, _), hot_entry in zip(parts, hot_entries):
+                self.hot.put(key, hot_entry)
+
+        def make_entries():
+            return [self.make_entry(*part, hot_entry) for part, hot_entry in zip(parts, hot_entries)]
+
+        if isinstance(self.backend, WriteBehindBackend):
+            # Encoding, compressing and building the permutations and index are left to the background job too
+            self.backend.put_later(make_entries)
+        else:
+            self.backend.put_entries(make_entries())
+
+    def get_page(self, key):
+        return self.local.get_page(key)
+
+    def get_page_generation(self):
+        self.check_generation()
+        return self.local.get_page_generation()
+
+    def put_pages(self, pages):
+        """
+        Replaces all the materialized pages and bumps the page generation.
+
+        Args:
+            pages: A dict of page key to encoded page.
+        """
+        self.local.put_pages(pages)
+
     def close(self):
-        self.env.close()
-
-    def delete_year_data(self, year):
-        with self.env.begin(write=True) as txn:
-            for key, val in txn.cursor(db=self.calls):
-                if int.from_bytes(txn.get(key, db=self.years)) == year:
-                    txn.delete(key, db=self.calls)
-                    txn.delete(key, db=self.years)
\ No newline at end of file
+        self.backend.close()
+
+    def delete_year_data(self, year, before_version=None):
+        """
+        Deletes the cached stats covering a year.
+
+        Args:
+            year: The year.
+            before_version: Only delete the stats computed from data versions of the year below this one, so the
+                stats of newer versions can still be diffed against for since_version requests.
+        """
+        self.backend.delete_year(year, before_version)
+        if self.hot is not None:
+            self.hot.clear()
+
+shared_query_cache = None
+
+def get_query_cache():
+    """
+    Gets the QueryCache shared by every request handled by this worker, configured from the settings.
+    """
+    global shared_query_cache
+    if shared_query_cache is None:
+        shared = None
+        if settings.CACHE_SHARED_URL:
+            shared = make_shared_backend(settings.CACHE_SHARED_URL, settings.CACHE_SHARED_TTL, settings.CACHE_SHARED_TIMEOUT)
+        shared_query_cache = QueryCache(
+            db_path=settings.CACHE_PATH,
+            sort_keys=settings.CACHE_SORT_KEYS,
+            compression_level=settings.CACHE_COMPRESSION_LEVEL if settings.CACHE_COMPRESSION else None,
+            shared=shared,
+            hot=HotCache(settings.HOT_CACHE_MAX_BYTES, settings.HOT_CACHE_TTL) if settings.HOT_CACHE_MAX_BYTES else None,
+            write_behind=settings.CACHE_WRITE_BEHIND,
+        )
+    return shared_query_cache
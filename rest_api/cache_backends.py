@@ -0,0 +1,499 @@
+import logging
+import queue
+import socket
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlparse
+
+import lmdb
+import msgspec
+import msgspec.msgpack as msgpack
+
+logger = logging.getLogger(__name__)
+
+# A cache entry: the encoded stats, the years they cover, a dict of sort key to sort permutation, a dict of
+# "column:value" to the encoded rows with that value, and the data version of each year it covers
+CacheEntry = namedtuple("CacheEntry", ["key", "value", "years", "orders", "index", "versions"])
+
+
+def is_outdated(entry_years, entry_versions, year, before_version):
+    # Whether an entry covering year should be deleted by delete_year(year, before_version)
+    return year in entry_years and (before_version is None or entry_versions[entry_years.index(year)] < before_version)
+
+
+class CacheBackend:
+    """
+    Storage behind QueryCache. Entries are keyed by the hash of the params they were computed for.
+    """
+
+    def get_values(self, keys):
+        """Gets the encoded stats of each key, or None for keys that are not cached."""
+        raise NotImplementedError
+
+    def get_orders(self, keys, sort):
+        """Gets the permutation of each key's stats for a sort key, or None where there is none."""
+        raise NotImplementedError
+
+    def get_index(self, keys, name):
+        """Gets the rows an index name points to in each key's stats, b"" where there are none, or None for keys that are not cached."""
+        raise NotImplementedError
+
+    def get_entries(self, keys):
+        """Gets the full CacheEntry of each key, or None for keys that are not cached. Only used on the shared tier."""
+        raise NotImplementedError
+
+    def put_entries(self, entries):
+        raise NotImplementedError
+
+    def delete_year(self, year, before_version=None):
+        """Deletes every entry covering a year, or only those computed from data older than before_version."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LMDBBackend(CacheBackend):
+    def __init__(self, db_path, map_size):
+        self.map_size = map_size
+        self.open(db_path)
+
+    def open(self, db_path):
+        """
+        Opens the environment at db_path, replacing the one that was open. The old environment is closed once
+        nothing uses it anymore, so reads that already started on it can finish.
+        """
+        self.env = lmdb.open(db_path, map_size=self.map_size, readahead=False, max_dbs=5)
+        self.calls = self.env.open_db(b"calls")
+        self.years = self.env.open_db(b"years", dupsort=True)
+        # Permutations that put each entry in the order of a sort key, keyed by entry key + sort key
+        self.sorts = self.env.open_db(b"sorts")
+        # The rows of each player and team in each entry, keyed by entry key + "column:value"
+        self.index = self.env.open_db(b"index")
+        # Materialized leaderboard pages, keyed by page key, plus the generation of the current set of pages
+        self.pages = self.env.open_db(b"pages")
+
+    def get_values(self, keys):
+        with self.env.begin(write=False) as txn:
+            return [txn.get(key, db=self.calls) for key in keys]
+
+    def get_orders(self, keys, sort):
+        with self.env.begin(write=False) as txn:
+            return [txn.get(key + sort.encode(), db=self.sorts) for key in keys]
+
+    def get_index(self, keys, name):
+        records = []
+        with self.env.begin(write=False) as txn:
+            for key in keys:
+                record = txn.get(key + name.encode(), db=self.index)
+                # The years db tells whether the entry is cached without reading its value
+                if record is None and txn.get(key, db=self.years) is not None:
+                    record = b""
+                records.append(record)
+        return records
+
+    def put_entries(self, entries):
+        with self.env.begin(write=True) as txn:
+            for entry in entries:
+                txn.put(entry.key, entry.value, db=self.calls)
+                for year, version in zip(entry.years, entry.versions):
+                    txn.put(entry.key, year.to_bytes(2) + version.to_bytes(8), db=self.years)
+                for sort, order in entry.orders.items():
+                    txn.put(entry.key + sort.encode(), order, db=self.sorts)
+                for name, rows in entry.index.items():
+                    txn.put(entry.key + name.encode(), rows, db=self.index)
+
+    def delete_year(self, year, before_version=None):
+        with self.env.begin(write=True) as txn:
+            # Career entries have one duplicate per year they cover, so every duplicate has to be checked
+            keys = {key for key, stamp in txn.cursor(db=self.years)
+                    if int.from_bytes(stamp[:2]) == year and (before_version is None or int.from_bytes(stamp[2:]) < before_version)}
+            for key in keys:
+                txn.delete(key, db=self.calls)
+                txn.delete(key, db=self.years)
+                for db in (self.sorts, self.index):
+                    cursor = txn.cursor(db=db)
+                    if cursor.set_range(key):
+                        while cursor.key().startswith(key) and cursor.delete():
+                            pass
+
+    def get_page(self, key):
+        with self.env.begin(write=False) as txn:
+            return txn.get(key, db=self.pages)
+
+    def get_page_generation(self):
+        with self.env.begin(write=False) as txn:
+            return int.from_bytes(txn.get(b"generation", default=b"", db=self.pages))
+
+    def put_pages(self, pages):
+        with self.env.begin(write=True) as txn:
+            generation = int.from_bytes(txn.get(b"generation", default=b"", db=self.pages)) + 1
+            txn.drop(self.pages, delete=False)
+            for key, page in pages.items():
+                txn.put(key, page, db=self.pages)
+            txn.put(b"generation", generation.to_bytes(8), db=self.pages)
+
+    def close(self):
+        self.env.close()
+
+
+class MemoryBackend(CacheBackend):
+    """
+    Keeps entries in a dict. Stands in for a shared cache server in tests and single node setups.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def get_values(self, keys):
+        return [self.entries[key].value if key in self.entries else None for key in keys]
+
+    def get_orders(self, keys, sort):
+        return [self.entries[key].orders.get(sort) if key in self.entries else None for key in keys]
+
+    def get_index(self, keys, name):
+        return [self.entries[key].index.get(name, b"") if key in self.entries else None for key in keys]
+
+    def get_entries(self, keys):
+        return [self.entries.get(key) for key in keys]
+
+    def put_entries(self, entries):
+        for entry in entries:
+            self.entries[entry.key] = entry
+
+    def delete_year(self, year, before_version=None):
+        for key in [key for key, entry in self.entries.items() if is_outdated(entry.years, entry.versions, year, before_version)]:
+            del self.entries[key]
+
+
+class RedisError(Exception):
+    pass
+
+
+class SharedEntry(msgspec.Struct, array_like=True):
+    """
+    A cache entry as it is stored in the shared cache, without its key.
+    """
+    value: bytes
+    years: list[int]
+    orders: dict[str, bytes | None]
+    index: dict[str, bytes]
+    # Entries stored before data versions were recorded have none, and are treated as version 0
+    versions: list[int] | None = None
+
+
+class RedisBackend(CacheBackend):
+    """
+    Shared cache on a server speaking the Redis protocol, so every node can use entries computed by the others.
+
+    Each entry is stored as a single msgpack value that expires after ttl seconds, and a set per year lists
+    the entries covering it so delete_year does not have to scan the keyspace.
+    """
+
+    prefix = b"baseballquery:"
+
+    def __init__(self, host, port, db=0, password=None, ttl=60 * 60 * 24 * 30, timeout=1.0):
+        self.address = (host, port)
+        self.db = db
+        self.password = password
+        self.ttl = ttl
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        self.sock, self.reader = sock, sock.makefile("rb")
+        if self.password:
+            self.execute([[b"AUTH", self.password]])
+        if self.db:
+            self.execute([[b"SELECT", self.db]])
+
+    def execute(self, commands):
+        """
+        Sends a pipeline of commands and reads all of their replies.
+
+        Args:
+            commands: A list of commands, each a list of arguments.
+
+        Returns:
+            The list of replies.
+        """
+        if self.sock is None:
+            raise ConnectionError("Not connected to the shared cache")
+        data = []
+        for command in commands:
+            data.append(b"*%d\r\n" % len(command))
+            for arg in command:
+                arg = arg if isinstance(arg, bytes) else str(arg).encode()
+                data.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self.sock.sendall(b"".join(data))
+        return [self.read_reply() for _ in commands]
+
+    def read_reply(self):
+        """
+        Reads one reply, parsing the Redis protocol (RESP2).
+
+        Returns:
+            The reply, as bytes for status and bulk replies, an int, a list of replies, or None for null replies.
+
+        Raises:
+            RedisError: If the reply is an error.
+        """
+        if self.reader is None:
+            raise ConnectionError("Not connected to the shared cache")
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Connection to the shared cache was closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest
+        if kind == b"-":
+            raise RedisError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            if int(rest) == -1:
+                return None
+            data = self.reader.read(int(rest) + 2)
+            return data[:-2]
+        if kind == b"*":
+            if int(rest) == -1:
+                return None
+            return [self.read_reply() for _ in range(int(rest))]
+        raise RedisError(f"Unexpected reply {line!r}")
+
+    def run(self, commands):
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self.connect()
+                return self.execute(commands)
+            except (OSError, RedisError):
+                # Drop the connection so the next command starts from a clean state
+                self.close()
+                raise
+
+    def run_strings(self, command):
+        # Runs a single command whose reply is an array of bulk strings, which are None for missing keys
+        reply = self.run([command])[0]
+        if not isinstance(reply, list):
+            raise RedisError(f"Unexpected reply {reply!r} to {command[0].decode()}")
+        strings = []
+        for item in reply:
+            if item is not None and not isinstance(item, bytes):
+                raise RedisError(f"Unexpected reply {reply!r} to {command[0].decode()}")
+            strings.append(item)
+        return strings
+
+    def get_entries(self, keys):
+        if not keys:
+            return []
+        values = self.run_strings([b"MGET", *[self.prefix + b"entry:" + key for key in keys]])
+        entries = []
+        for key, value in zip(keys, values):
+            if value is None:
+                entries.append(None)
+            else:
+                entry = msgpack.decode(value, type=SharedEntry)
+                versions = [0] * len(entry.years) if entry.versions is None else entry.versions
+                entries.append(CacheEntry(key, entry.value, entry.years, entry.orders, entry.index, versions))
+        return entries
+
+    def get_values(self, keys):
+        return [None if entry is None else entry.value for entry in self.get_entries(keys)]
+
+    def get_orders(self, keys, sort):
+        return [None if entry is None else entry.orders.get(sort) for entry in self.get_entries(keys)]
+
+    def get_index(self, keys, name):
+        return [None if entry is None else entry.index.get(name, b"") for entry in self.get_entries(keys)]
+
+    def put_entries(self, entries):
+        commands = []
+        for entry in entries:
+            value = msgpack.encode(SharedEntry(entry.value, list(entry.years), entry.orders, entry.index, list(entry.versions)))
+            commands.append([b"SET", self.prefix + b"entry:" + entry.key, value, b"EX", self.ttl])
+            for year in entry.years:
+                commands.append([b"SADD", self.prefix + b"year:%d" % year, entry.key])
+                commands.append([b"EXPIRE", self.prefix + b"year:%d" % year, self.ttl])
+        if commands:
+            self.run(commands)
+
+    def delete_year(self, year, before_version=None):
+        keys = [key for key in self.run_strings([b"SMEMBERS", self.prefix + b"year:%d" % year]) if key is not None]
+        if before_version is not None and keys:
+            entries = self.get_entries(keys)
+            keys = [key for key, entry in zip(keys, entries) if entry is None or is_outdated(entry.years, entry.versions, year, before_version)]
+        if keys:
+            self.run([
+                [b"DEL", *[self.prefix + b"entry:" + key for key in keys]],
+                [b"SREM", self.prefix + b"year:%d" % year, *keys],
+            ])
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.reader = None
+
+
+class TieredBackend(CacheBackend):
+    """
+    A local cache (L1) in front of a shared cache (L2).
+
+    Reads that miss L1 fall through to L2 and copy what they find into L1. Writes go to L1 right away and are
+    written behind to L2 by a background thread. L2 is best effort: if it is down, the cache keeps working from L1
+    and only tries L2 again after retry_interval seconds.
+    """
+
+    def __init__(self, local, shared, queue_size=1000, retry_interval=30):
+        self.local = local
+        self.shared = shared
+        self.retry_interval = retry_interval
+        self.shared_down_until = 0.0
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.writer = threading.Thread(target=self.write_behind, daemon=True)
+        self.writer.start()
+
+    def get_values(self, keys):
+        values = self.local.get_values(keys)
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if not missing or time.monotonic() < self.shared_down_until:
+            return values
+        try:
+            found = {entry.key: entry for entry in self.shared.get_entries(missing) if entry is not None}
+        except (OSError, RedisError):
+            logger.exception("Reading from the shared cache failed")
+            self.shared_down_until = time.monotonic() + self.retry_interval
+            return values
+        if found:
+            self.local.put_entries(list(found.values()))
+        return [found[key].value if value is None and key in found else value for key, value in zip(keys, values)]
+
+    def get_orders(self, keys, sort):
+        # get_values already copied any entries found in L2 into L1
+        return self.local.get_orders(keys, sort)
+
+    def get_index(self, keys, name):
+        records = self.local.get_index(keys, name)
+        missing = [key for key, record in zip(keys, records) if record is None]
+        if missing and any(value is not None for value in self.get_values(missing)):
+            # get_values copied the entries found in L2 into L1
+            records = self.local.get_index(keys, name)
+        return records
+
+    def put_entries(self, entries):
+        self.local.put_entries(entries)
+        try:
+            self.queue.put_nowait(entries)
+        except queue.Full:
+            logger.warning("Shared cache write queue is full, dropping %d entries", len(entries))
+
+    def write_behind(self):
+        while True:
+            entries = self.queue.get()
+            try:
+                self.shared.put_entries(entries)
+            except (OSError, RedisError):
+                logger.exception("Writing to the shared cache failed")
+            finally:
+                self.queue.task_done()
+
+    def delete_year(self, year, before_version=None):
+        self.local.delete_year(year, before_version)
+        # Pending writes could be for the year being deleted
+        self.queue.join()
+        try:
+            self.shared.delete_year(year, before_version)
+        except (OSError, RedisError):
+            # The shared entries expire after their ttl, and the new data versions give new keys anyway
+            logger.exception("Deleting from the shared cache failed")
+
+    def close(self):
+        # Finish the pending writes before closing
+        self.queue.join()
+        self.local.close()
+        self.shared.close()
+
+
+class WriteBehindBackend(CacheBackend):
+    """
+    Writes entries to another backend from a background thread, so requests do not wait for the write. Entries can
+    also be built in the background, with put_later.
+
+    If the queue is full, entries are written right away instead of being dropped.
+    """
+
+    def __init__(self, backend, queue_size=1000):
+        self.backend = backend
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.writer = threading.Thread(target=self.write_behind, daemon=True)
+        self.writer.start()
+
+    def get_values(self, keys):
+        return self.backend.get_values(keys)
+
+    def get_orders(self, keys, sort):
+        return self.backend.get_orders(keys, sort)
+
+    def get_index(self, keys, name):
+        return self.backend.get_index(keys, name)
+
+    def put_entries(self, entries):
+        self.put_later(lambda: entries)
+
+    def put_later(self, make_entries):
+        """
+        Builds entries and writes them, both in the background.
+
+        Args:
+            make_entries: A function that returns the entries.
+        """
+        try:
+            self.queue.put_nowait(make_entries)
+        except queue.Full:
+            self.backend.put_entries(make_entries())
+
+    def write_behind(self):
+        while True:
+            make_entries = self.queue.get()
+            try:
+                self.backend.put_entries(make_entries())
+            except Exception:
+                logger.exception("Writing to the cache failed")
+            finally:
+                self.queue.task_done()
+
+    def delete_year(self, year, before_version=None):
+        # Pending writes could be for the year being deleted
+        self.queue.join()
+        self.backend.delete_year(year, before_version)
+
+    def close(self):
+        self.queue.join()
+        self.backend.close()
+
+
+def make_shared_backend(url, ttl, timeout):
+    """
+    Creates the shared cache tier from a URL.
+
+    Args:
+        url: "redis://[:password@]host[:port][/db]" for a Redis protocol server, or "memory://" for an
+            in-process stand-in.
+        ttl: How long entries are kept in a Redis server, in seconds.
+        timeout: The socket timeout for a Redis server, in seconds.
+
+    Returns:
+        The backend.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "memory":
+        return MemoryBackend()
+    if parsed.scheme == "redis":
+        db = int(parsed.path.lstrip("/") or 0)
+        return RedisBackend(parsed.hostname or "localhost", parsed.port or 6379, db, parsed.password, ttl, timeout)
+    raise ValueError(f"Unsupported shared cache URL '{url}'")
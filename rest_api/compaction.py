@@ -0,0 +1,127 @@
+import fcntl
+import os
+import shutil
+import time
+
+from rest_api.cache_backends import LMDBBackend
+
+# Entry keys are sha1 digests. Records in the sorts and index dbs are keyed by entry key + a name.
+key_size = 20
+
+
+def current_generation(db_path):
+    """
+    Gets the directory of the LMDB environment the query cache should use.
+
+    Compacted generations live in db_path/generations/<number>, and db_path/current links to the one in use.
+    Before the first compaction, the environment is in db_path itself.
+    """
+    link = os.path.join(db_path, "current")
+    if os.path.islink(link):
+        return os.path.realpath(link)
+    return db_path
+
+
+def generation_numbers(db_path):
+    generations_dir = os.path.join(db_path, "generations")
+    if not os.path.isdir(generations_dir):
+        return []
+    return sorted(int(name) for name in os.listdir(generations_dir) if name.isdigit())
+
+
+def copy_filtered(source, target, drop_years):
+    """
+    Copies every entry that does not cover one of drop_years, and all the materialized pages.
+
+    Returns:
+        The number of entries left out.
+    """
+    with source.env.begin() as read_txn, target.env.begin(write=True) as write_txn:
+        dropped = {key for key, year in read_txn.cursor(db=source.years) if int.from_bytes(year[:2]) in drop_years}
+        for source_db, target_db in [(source.calls, target.calls), (source.years, target.years), (source.sorts, target.sorts), (source.index, target.index), (source.pages, target.pages)]:
+            write_cursor = write_txn.cursor(db=target_db)
+            previous_key = None
+            for key, value in read_txn.cursor(db=source_db):
+                if source_db is source.pages or key[:key_size] not in dropped:
+                    # Records are read in key order, so they can be appended, which fills every page instead of
+                    # splitting them. Appending only takes keys greater than the last one, so the other years of a
+                    # career entry are added as regular duplicates.
+                    write_cursor.put(key, value, append=key != previous_key)
+                    previous_key = key
+    return len(dropped)
+
+
+def compact_cache(db_path, map_size=1024*1024*1024*1024, drop_years=(), keep=2):
+    """
+    Copies the current generation of the query cache into a new, compacted generation and makes it current.
+
+    The copy is made from a snapshot, so the cache keeps serving while it runs. Entries written to the old generation
+    after the snapshot are not copied, they will be computed again. Workers switch to the new generation within
+    CACHE_GENERATION_CHECK_INTERVAL seconds. A run waits for any other run to finish first.
+
+    Args:
+        db_path: The query cache directory, settings.CACHE_PATH.
+        map_size: The map size to open the environments with.
+        drop_years: Entries covering any of these years are left out of the copy.
+        keep: How many generations to keep, including the new one. Older ones are deleted.
+
+    Returns:
+        A dict with the new generation, the sizes before and after, the space reclaimed, the number of entries left
+        out, and the seconds it took.
+    """
+    os.makedirs(db_path, exist_ok=True)
+    # Runs are one at a time, otherwise two of them would make the same generation
+    with open(os.path.join(db_path, "compact.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        start = time.monotonic()
+        source_path = current_generation(db_path)
+        numbers = generation_numbers(db_path)
+        generation = numbers[-1] + 1 if numbers else 1
+        target_path = os.path.join(db_path, "generations", str(generation))
+        os.makedirs(target_path)
+
+        source = LMDBBackend(source_path, map_size)
+        try:
+            if drop_years:
+                target = LMDBBackend(target_path, map_size)
+                try:
+                    dropped = copy_filtered(source, target, set(drop_years))
+                finally:
+                    target.close()
+            else:
+                # LMDB's own compacting copy leaves out the free pages
+                source.env.copy(target_path, compact=True)
+                dropped = 0
+        except Exception:
+            shutil.rmtree(target_path)
+            raise
+        finally:
+            source.close()
+
+        # Replacing the link is atomic, so workers either see the old generation or the new one
+        tmp_link = os.path.join(db_path, "current.tmp")
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.join("generations", str(generation)), tmp_link)
+        os.replace(tmp_link, os.path.join(db_path, "current"))
+
+        size_before = os.path.getsize(os.path.join(source_path, "data.mdb"))
+        size_after = os.path.getsize(os.path.join(target_path, "data.mdb"))
+
+        # Deleting a generation does not affect workers that still have it open, its pages stay mapped until they switch
+        for number in generation_numbers(db_path)[:-keep]:
+            shutil.rmtree(os.path.join(db_path, "generations", str(number)))
+        if source_path != db_path:
+            # The environment from before the first compaction is never used again after the second one
+            for name in ("data.mdb", "lock.mdb"):
+                if os.path.exists(os.path.join(db_path, name)):
+                    os.remove(os.path.join(db_path, name))
+
+        return {
+            "generation": generation,
+            "size_before": size_before,
+            "size_after": size_after,
+            "reclaimed": size_before - size_after,
+            "dropped_entries": dropped,
+            "seconds": time.monotonic() - start,
+        }
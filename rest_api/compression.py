@@ -0,0 +1,86 @@
+import gzip
+from collections import OrderedDict
+
+import brotli
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+# Compressed bodies of responses that are sent over and over, keyed by the response's compression key and encoding
+precompressed = OrderedDict()
+
+
+def negotiate(accept_encoding):
+    """
+    Picks the content encoding to use from an Accept-Encoding header, preferring brotli over gzip.
+
+    Args:
+        accept_encoding: The value of the Accept-Encoding header.
+
+    Returns:
+        "br", "gzip", or None if the response should not be compressed.
+    """
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    for coding in ("br", "gzip"):
+        if qualities.get(coding, qualities.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=settings.COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=settings.COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+def compress_response(request, response):
+    """
+    Compresses a response with the best encoding the client accepts.
+
+    Responses with a compression_key attribute are only compressed once per worker, after which the
+    compressed body is reused for every response with the same key.
+
+    Args:
+        request: The request.
+        response: The rendered response.
+
+    Returns:
+        The response.
+    """
+    if response.streaming or response.status_code != 200 or response.has_header("Content-Encoding"):
+        return response
+    patch_vary_headers(response, ("Accept-Encoding",))
+    if len(response.content) < settings.COMPRESSION_MIN_SIZE:
+        return response
+    encoding = negotiate(request.headers.get("Accept-Encoding", ""))
+    if encoding is None:
+        return response
+
+    key = getattr(response, "compression_key", None)
+    if key is None:
+        response.content = compress(response.content, encoding)
+    elif (key, encoding) in precompressed:
+        precompressed.move_to_end((key, encoding))
+        response.content = precompressed[(key, encoding)]
+    else:
+        response.content = compress(response.content, encoding)
+        precompressed[(key, encoding)] = response.content
+        if len(precompressed) > settings.COMPRESSION_MEMO_SIZE:
+            precompressed.popitem(last=False)
+
+    response["Content-Encoding"] = encoding
+    response["Content-Length"] = str(len(response.content))
+    # The compressed body is a different representation, so like GZipMiddleware only keep a weak ETag
+    etag = response.get("ETag")
+    if etag and not etag.startswith("W/"):
+        response["ETag"] = "W/" + etag
+    return response
@@ -0,0 +1,65 @@
+import os
+import time
+from datetime import datetime
+
+from baseballquery.database import db_path, engine
+from django.conf import settings
+
+from rest_api import versions
+
+# update_new_data.py publishes a new dataset by renaming it over the database file, which gives the file a new inode.
+# Connections that are already open keep reading the old file, so the engine's pool is dropped once the inode changes.
+loaded_inode = None
+checked_at = 0.0
+checked_versions = None
+# The latest season in the dataset, read from the years.txt the library writes after every update
+loaded_years_mtime = None
+loaded_latest_year = None
+
+
+def database_inode():
+    try:
+        return os.stat(db_path).st_ino
+    except FileNotFoundError:
+        return None
+
+
+def check_dataset():
+    """
+    Makes the library open new connections to the database once a new dataset has been published.
+
+    Called before computing stats, and only checks the file every DATASET_CHECK_INTERVAL seconds, or once the data
+    versions changed: update_new_data.py publishes the dataset before the versions, so stats cached under a new
+    version are always computed from the new dataset.
+    """
+    global loaded_inode, checked_at, checked_versions
+    if time.monotonic() - checked_at < settings.DATASET_CHECK_INTERVAL and versions.loaded_mtime == checked_versions:
+        return
+    checked_at = time.monotonic()
+    checked_versions = versions.loaded_mtime
+    inode = database_inode()
+    if inode != loaded_inode:
+        engine.dispose()
+        loaded_inode = inode
+
+
+def latest_year():
+    """
+    Gets the latest season in the dataset, which queries without years are for. Before the first update, the
+    current year.
+    """
+    global loaded_years_mtime, loaded_latest_year
+    path = db_path.parent / "years.txt"
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return datetime.now().year
+    if mtime != loaded_years_mtime:
+        with open(path) as f:
+            years = [int(year) for year in f.read().split()]
+        loaded_latest_year = max(years, default=datetime.now().year)
+        loaded_years_mtime = mtime
+    return loaded_latest_year
+
+
+loaded_inode = database_inode()
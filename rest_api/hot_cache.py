@@ -0,0 +1,126 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from rest_api import versions
+
+# How many rows of an entry are measured to estimate its size
+size_sample_rows = 8
+
+
+def decoded_size(rows):
+    """
+    Estimates the memory taken by decoded rows from the size of a sample of them, counting each row's dict and values
+    but not its keys, which are shared between rows. It comes out somewhat high, since small ints are shared too.
+
+    Args:
+        rows: A tuple of row dicts.
+
+    Returns:
+        The estimate in bytes.
+    """
+    if not rows:
+        return sys.getsizeof(rows)
+    sample = rows[::max(1, len(rows) // size_sample_rows)][:size_sample_rows]
+    sample_size = sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values() if value is not None) for row in sample)
+    return sys.getsizeof(rows) + len(rows) * sample_size // len(sample)
+
+
+class HotEntry:
+    """
+    The decoded rows of a cache entry, plus the sort permutations of them that have been read so far.
+
+    rows is a tuple and the rows in it are shared by every request that reads the entry, so they must not be modified.
+    """
+    __slots__ = ("rows", "size", "orders", "expires_at")
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.size = decoded_size(rows)
+        self.orders = {}
+        self.expires_at = 0.0
+
+
+class HotCache:
+    """
+    A per-worker LRU of decoded cache entries, so the hottest entries are not decoded again on every request.
+
+    Entries are keyed by cache entry key, which already includes the data version of the years they cover. On top of
+    that, the whole cache is dropped whenever the data versions file changes, so memory is not held by entries no
+    request will ask for again.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = versions.loaded_mtime
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def check_generation(self):
+        # entry_keys reads the versions file before every lookup, so its mtime is current here
+        if versions.loaded_mtime != self.generation:
+            self.generation = versions.loaded_mtime
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            self.check_generation()
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires_at < time.monotonic():
+                self.remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        with self.lock:
+            self.check_generation()
+            if key in self.entries:
+                self.remove(key)
+            entry.expires_at = time.monotonic() + self.ttl
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        self.size -= self.entries.pop(key).size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,112 @@
+import time
+from hashlib import sha1
+
+import msgspec.json as json
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from rest_api.cache import get_query_cache
+from rest_api.query import parse_query
+from rest_api.serialization import fill_sentinels
+from rest_api.versions import get_year_versions
+
+# Pages this worker has already read from LMDB, and the page generation they belong to
+memory = {}
+memory_generation = None
+generation_checked_at = 0.0
+
+
+def page_key(query, page_size, page):
+    # Pages materialized from older data have other keys, so they are never served once a year gets new data
+    year_versions = get_year_versions(query.params["start_year"], query.params["end_year"])
+    return sha1(query.key + json.encode([page_size, page, sorted(year_versions.items())])).digest()
+
+
+def encode_page(count, rows):
+    # The count is stored in front of the encoded results
+    return count.to_bytes(4) + json.encode(fill_sentinels(rows))
+
+
+def get_page(key):
+    global memory_generation, generation_checked_at
+    cache = get_query_cache()
+    # Only check for a new generation every so often, so hot pages are served without touching LMDB
+    if time.monotonic() - generation_checked_at > settings.LEADERBOARD_CHECK_INTERVAL:
+        generation = cache.get_page_generation()
+        if generation != memory_generation:
+            memory.clear()
+            memory_generation = generation
+        generation_checked_at = time.monotonic()
+    if key not in memory:
+        page = cache.get_page(key)
+        if page is None:
+            return None
+        memory[key] = page
+    return memory[key]
+
+
+def materialized_response(request, query):
+    """
+    Serves a request from the materialized leaderboards, if the requested page was materialized.
+
+    Args:
+        request: The request.
+        query: The Query of the request.
+
+    Returns:
+        The response, or None if the page has to be computed from the cache.
+    """
+    page = str(request.query_params.get("page", 1))
+    page_size = str(request.query_params.get("page_size", 50))
+    if not page.isdigit() or not page_size.isdigit():
+        return None
+    page, page_size = int(page), int(page_size)
+    if page > settings.LEADERBOARD_PAGES:
+        return None
+    key = page_key(query, page_size, page)
+    value = get_page(key)
+    if value is None:
+        return None
+    count = int.from_bytes(value[:4])
+    results = value[4:]
+
+    # Same body as PageNumberPagination.get_paginated_response
+    url = request.build_absolute_uri()
+    next_url = replace_query_param(url, "page", page + 1) if page * page_size < count else None
+    if page == 1:
+        previous_url = None
+    elif page == 2:
+        previous_url = remove_query_param(url, "page")
+    else:
+        previous_url = replace_query_param(url, "page", page - 1)
+    body = b'{"count":%d,"next":%s,"previous":%s,"results":%s}' % (count, json.encode(next_url), json.encode(previous_url), results)
+    response = HttpResponse(body, content_type="application/json")
+    # The body only depends on the page and the URL, so it only has to be compressed once per page generation
+    response.compression_key = (key, url, memory_generation)
+    return response
+
+
+def materialize_leaderboards():
+    """
+    Computes the first pages of every leaderboard in settings.LEADERBOARDS and stores them ready to be sent.
+
+    Run after every data update. Computing the leaderboards also fills the query cache for them.
+    """
+    # Imported here since the views import this module
+    from rest_api.views import get_stats
+
+    pages = {}
+    for leaderboard in settings.LEADERBOARDS:
+        query = parse_query(leaderboard["query"], leaderboard["type"])
+        page_size = int(leaderboard["query"].get("page_size", 50))
+        # Not admitted, since there are no requests to reject and a rejection would abort the update
+        stats = get_stats(query, admit=False)
+        for page in range(1, settings.LEADERBOARD_PAGES + 1):
+            rows = list(stats[(page - 1) * page_size:page * page_size])
+            if page > 1 and not rows:
+                break
+            pages[page_key(query, page_size, page)] = encode_page(len(stats), rows)
+
+    get_query_cache().put_pages(pages)
+    return len(pages)
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rest_api.compaction import compact_cache
+
+
+class Command(BaseCommand):
+    help = "Copies the query cache into a new compacted generation, which the workers then switch to."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--drop-year", type=int, action="append", default=[], help="Leave out the entries covering this year, e.g. a season whose data changed. Can be given more than once.")
+        parser.add_argument("--keep", type=int, default=2, help="How many generations to keep, including the new one.")
+
+    def handle(self, *args, **options):
+        if options["keep"] < 1:
+            raise CommandError("--keep must be at least 1")
+        result = compact_cache(settings.CACHE_PATH, drop_years=options["drop_year"], keep=options["keep"])
+        self.stdout.write(
+            f"Compacted the query cache into generation {result['generation']} in {result['seconds']:.1f}s: "
+            f"{result['size_before'] / 1e6:.1f} MB -> {result['size_after'] / 1e6:.1f} MB "
+            f"({result['reclaimed'] / 1e6:.1f} MB reclaimed, {result['dropped_entries']} entries dropped)"
+        )
@@ -0,0 +1,210 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+
+import greenlet
+import msgspec.json as json
+from django.conf import settings
+
+# Profiles are written as <key>.pstats, <key>.collapsed and <key>.json (what was profiled) in settings.PROFILE_DIR
+profile_formats = ["pstats", "collapsed", "json"]
+
+# Stacks deeper than this are cut off in the collapsed output
+max_stack_depth = 200
+
+
+def should_profile(request):
+    """
+    Decides whether to profile a request: either an admin asked for it with ?profile=1, or it was sampled.
+
+    Args:
+        request: The Django request, before DRF wraps it.
+    """
+    if request.GET.get("profile") == "1" and request.user.is_staff:
+        return True
+    return settings.PROFILE_SAMPLE_RATE > 0 and random.random() < settings.PROFILE_SAMPLE_RATE
+
+
+def frame_label(func):
+    filename, line, name = func
+    if filename == "~":
+        # Built-in functions
+        return name
+    return f"{os.path.basename(filename)}:{line}({name})".replace(";", ":")
+
+
+def collapsed_stacks(stats):
+    """
+    Turns pstats data into collapsed stacks, one "frame;frame;frame microseconds" line per stack, for flame graphs.
+
+    cProfile only records caller -> callee edges, not full stacks, so the time of a function called from several
+    places is split between its callers in proportion to the time each of those calls took.
+
+    Args:
+        stats: A pstats.Stats.
+
+    Returns:
+        The collapsed stacks as a string.
+    """
+    children = defaultdict(list)
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, (_, _, caller_tt, caller_ct) in callers.items():
+            children[caller].append((func, caller_tt, caller_ct))
+
+    lines = Counter()
+
+    def walk(func, stack, tt, ct):
+        stack = stack + (frame_label(func),)
+        lines[";".join(stack)] += tt
+        total_ct = stats.stats[func][3]
+        if not total_ct or len(stack) >= max_stack_depth:
+            return
+        # The share of this function's time that was spent on this stack
+        share = ct / total_ct
+        for child, child_tt, child_ct in children[func]:
+            if child_ct * share < 1e-6 or frame_label(child) in stack:
+                continue
+            walk(child, stack, child_tt * share, child_ct * share)
+
+    for func, (_, _, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            walk(func, (), tt, ct)
+    return "".join(f"{stack} {round(seconds * 1e6)}\n" for stack, seconds in lines.items() if round(seconds * 1e6) > 0)
+
+
+def save_profile(profiler, key, info):
+    """
+    Stores a profile, replacing any older profile with the same key, and deletes the oldest profiles once there are
+    more than settings.PROFILE_MAX_COUNT. The collapsed stacks are only made when they are first read.
+
+    Args:
+        profiler: The cProfile.Profile, after it was disabled.
+        key: The key of the profiled query.
+        info: A dict describing the profiled request.
+    """
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    path = os.path.join(settings.PROFILE_DIR, key)
+    profiler.dump_stats(f"{path}.pstats")
+    try:
+        # Collapsed stacks of an older profile with the same key
+        os.remove(f"{path}.collapsed")
+    except FileNotFoundError:
+        pass
+    with open(f"{path}.json", "wb") as f:
+        f.write(json.encode({**info, "key": key}))
+
+    profiles = sorted((entry for entry in os.scandir(settings.PROFILE_DIR) if entry.name.endswith(".json")), key=lambda entry: entry.stat().st_mtime)
+    for entry in profiles[:-settings.PROFILE_MAX_COUNT]:
+        for format in profile_formats:
+            try:
+                os.remove(os.path.join(settings.PROFILE_DIR, f"{entry.name[:-len('.json')]}.{format}"))
+            except FileNotFoundError:
+                pass
+
+
+# Since Python 3.12 only one profiler can be active per thread, and all the greenlets of a gevent worker run on one
+# thread, so only one call per process is profiled at a time.
+profiler_lock = threading.Lock()
+
+
+def count_switches(current):
+    """
+    Counts the switches away from a greenlet until stop is called, chaining to any other greenlet tracer.
+
+    Returns:
+        A tuple of a list with the count as its only item, and stop.
+    """
+    switches = [0]
+
+    def trace(event, args):
+        if event in ("switch", "throw") and args[0] is current:
+            switches[0] += 1
+        if previous is not None:
+            previous(event, args)
+
+    previous = greenlet.settrace(trace)
+
+    def stop():
+        greenlet.settrace(previous)
+
+    return switches, stop
+
+
+def profile_call(key, info, func, *args, **kwargs):
+    """
+    Runs a function under cProfile and stores the profile under key, after the function returned and in the
+    background. If another call is already being profiled, the function just runs.
+
+    The profiler sees everything that runs on the worker's thread, so when the call waits on I/O and gevent switches
+    to other requests, their work is included in the profile. The profile's info records whether that happened as
+    includes_concurrent_requests. Pausing the profiler on those switches is not an option, since disabling cProfile
+    ends every call on its stack and the rest of the profile would lose its callers.
+
+    Returns:
+        A tuple of what the function returned and whether it was profiled.
+    """
+    if not profiler_lock.acquire(blocking=False):
+        return func(*args, **kwargs), False
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiling tool, e.g. a debugger, is active
+        profiler_lock.release()
+        return func(*args, **kwargs), False
+    info = {**info, "time": time.time()}
+    switches, stop_counting = count_switches(greenlet.getcurrent())
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs), True
+    finally:
+        profiler.disable()
+        stop_counting()
+        profiler_lock.release()
+        info["total_time"] = time.perf_counter() - start
+        info["includes_concurrent_requests"] = switches[0] > 0
+        threading.Thread(target=save_profile, args=(profiler, key, info), daemon=True).start()
+
+
+def list_profiles():
+    if not os.path.isdir(settings.PROFILE_DIR):
+        return []
+    profiles = []
+    for entry in os.scandir(settings.PROFILE_DIR):
+        if entry.name.endswith(".json"):
+            with open(entry.path, "rb") as f:
+                profiles.append(json.decode(f.read()))
+    return sorted(profiles, key=lambda profile: profile["time"], reverse=True)
+
+
+def read_profile(key, format):
+    """
+    Reads a stored profile.
+
+    Args:
+        key: The key of the profiled query.
+        format: "pstats" for the raw pstats file, "collapsed" for the collapsed stacks, or "text" for the top
+            functions by cumulative time.
+
+    Returns:
+        The profile as bytes, or None if there is no profile with that key.
+    """
+    if not key.isalnum():
+        return None
+    path = os.path.join(settings.PROFILE_DIR, key)
+    if not os.path.exists(f"{path}.pstats"):
+        return None
+    if format == "collapsed" and not os.path.exists(f"{path}.collapsed"):
+        with open(f"{path}.collapsed", "w") as f:
+            f.write(collapsed_stacks(pstats.Stats(f"{path}.pstats")))
+    if format == "text":
+        out = io.StringIO()
+        pstats.Stats(f"{path}.pstats", stream=out).sort_stats("cumulative").print_stats(60)
+        return out.getvalue().encode()
+    with open(f"{path}.{format}", "rb") as f:
+        return f.read()
@@ -0,0 +1,359 @@
+import re
+from functools import cached_property
+from hashlib import sha1
+from typing import Annotated, Literal, get_args
+
+import msgspec
+import msgspec.json as json
+from msgspec import Meta
+from rest_framework.exceptions import ValidationError
+
+from rest_api.dataset import latest_year
+from rest_api.versions import parse_version_token
+
+filter_params = ["filter_opposing", "filter_innings", "filter_top", "filter_stats", "filter_values", "filter_operators"]
+
+FilterCol = Literal[
+    "AB_FL",
+    "H_CD",
+    "SH_FL",
+    "SF_FL",
+    "EVENT_OUTS_CT",
+    "DP_FL",
+    "TP_FL",
+    "RBI_CT",
+    "WP_FL",
+    "PB_FL",
+    "BATTEDBALL_CD",
+    "BAT_DEST_ID",
+    "RUN1_DEST_ID",
+    "RUN2_DEST_ID",
+    "RUN3_DEST_ID",
+    "RUN1_SB_FL",
+    "RUN2_SB_FL",
+    "RUN3_SB_FL",
+    "RUN1_CS_FL",
+    "RUN2_CS_FL",
+    "RUN3_CS_FL",
+    "RUN1_PK_FL",
+    "RUN2_PK_FL",
+    "RUN3_PK_FL",
+    "RUN1_RESP_PIT_ID",
+    "RUN2_RESP_PIT_ID",
+    "RUN3_RESP_PIT_ID",
+    "HOME_TEAM_ID",
+    "BAT_TEAM_ID",
+    "FLD_TEAM_ID",
+    "PA_TRUNC_FL",
+    "START_BASES_CD",
+    "END_BASES_CD",
+    "RESP_BAT_START_FL",
+    "RESP_PIT_START_FL",
+    "PA_BALL_CT",
+    "PA_OTHER_BALL_CT",
+    "PA_STRIKE_CT",
+    "PA_OTHER_STRIKE_CT",
+    "EVENT_RUNS_CT",
+    "BAT_SAFE_ERR_FL",
+    "FATE_RUNS_CT",
+    "MLB_STATSAPI_APPROX",
+    "mlbam_id",
+    "0-0",
+    "0-1",
+    "0-2",
+    "1-0",
+    "1-1",
+    "1-2",
+    "2-0",
+    "2-1",
+    "2-2",
+    "3-0",
+    "3-1",
+    "3-2",
+    "PA",
+    "AB",
+    "SH",
+    "SF",
+    "R",
+    "RBI",
+    "SB",
+    "CS",
+    "K",
+    "BK",
+    "UBB",
+    "IBB",
+    "HBP",
+    "FC",
+    "1B",
+    "2B",
+    "3B",
+    "HR",
+    "H",
+    "DP",
+    "TP",
+    "ROE",
+    "WP",
+    "P",
+    "GB",
+    "FB",
+    "LD",
+    "PU",
+    "ER",
+    "T_UER",
+    "UER",
+
+    # Not actual columns, but the API allows filtering by these through backend logic
+    "SCORE",
+    "SCORE_DIFF",
+]
+
+Day = Literal["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+Operator = Literal["=", "<", ">", "<=", ">=", "!="]
+
+valid_filter_cols = list(get_args(FilterCol))
+valid_days = list(get_args(Day))
+valid_operators = list(get_args(Operator))
+
+YesNo = Literal["Y", "N"]
+Team = Annotated[str, Meta(pattern="^[A-Z]{3}$")]
+
+# Lists of integers, optionally bounded
+Ints = tuple[int, ...] | None
+NonNegativeInts = tuple[Annotated[int, Meta(ge=0)], ...] | None
+Innings = tuple[Annotated[int, Meta(ge=1)], ...] | None
+LineupPositions = tuple[Annotated[int, Meta(ge=1, le=9)], ...] | None
+FieldPositions = tuple[Annotated[int, Meta(ge=1, le=12)], ...] | None
+Outs = tuple[Annotated[int, Meta(ge=0, le=2)], ...] | None
+Strikes = tuple[Annotated[int, Meta(ge=0, le=3)], ...] | None
+Balls = tuple[Annotated[int, Meta(ge=0, le=4)], ...] | None
+BaseSituations = tuple[Annotated[int, Meta(ge=0, le=7)], ...] | None
+
+
+class Query(msgspec.Struct, frozen=True, kw_only=True, dict=True):
+    """
+    A stat query, decoded once from the query string of a request or the params of a saved query.
+
+    List params are comma separated in query strings and stored sorted, Y/N params stay "Y"/"N" until they are
+    turned into the normalized params. Queries are immutable and hashable.
+    """
+    type: Literal["batting", "pitching"]
+    start_year: int | None = None
+    end_year: int | None = None
+    split: Literal["year", "career", "month", "game"] = "year"
+    find: Literal["player", "team"] = "player"
+    days_of_week: tuple[Day, ...] | None = None
+    batter_handedness_pa: Literal["L", "R"] | None = None
+    pitcher_handedness: Literal["L", "R"] | None = None
+    batter_starter: YesNo | None = None
+    pitcher_starter: YesNo | None = None
+    batter_lineup_pos: LineupPositions = None
+    player_field_position: FieldPositions = None
+    batter_home: YesNo | None = None
+    pitcher_home: YesNo | None = None
+    pitching_team: tuple[Team, ...] | None = None
+    batting_team: tuple[Team, ...] | None = None
+    innings: Innings = None
+    outs: Outs = None
+    count: tuple[Annotated[str, Meta(pattern="^[0-2]-[0-3]$")], ...] | None = None
+    strikes: Strikes = None
+    balls: Balls = None
+    score_diff: Ints = None
+    home_score: NonNegativeInts = None
+    away_score: NonNegativeInts = None
+    base_situation: BaseSituations = None
+    filter_home: Literal["home", "away", "either"] | None = None
+    filter_opposing: YesNo | None = None
+    filter_innings: Innings = None
+    filter_top: tuple[YesNo, ...] | None = None
+    filter_stats: tuple[FilterCol, ...] | None = None
+    filter_values: Ints = None
+    filter_operators: tuple[Operator, ...] | None = None
+    player_id: str | None = None
+    team: Team | None = None
+    sort: str = "year,player_id"
+    min_pa: int = 0
+    min_ip: int = 0
+    since_version: str | None = None
+
+    def __post_init__(self):
+        if (self.start_year is None) != (self.end_year is None):
+            missing, given = ("end_year", "start_year") if self.end_year is None else ("start_year", "end_year")
+            raise ValueError(f"{missing} must be provided if {given} is provided")
+        if self.start_year is not None and self.end_year is not None and self.start_year > self.end_year:
+            raise ValueError("start_year cannot be greater than end_year")
+        if self.player_id is not None and self.team is not None:
+            raise ValueError("Only one of player_id and team can be given")
+        if self.since_version is not None:
+            parse_version_token(self.since_version)
+
+        given_filters = [param for param in filter_params if getattr(self, param) is not None]
+        if given_filters and len(given_filters) != len(filter_params):
+            raise ValueError("The filter feature requires all of filter_opposing, filter_innings, filter_top, filter_stats, filter_values, and filter_operators to be specified")
+        # Either all of the filter params were given or none were
+        if self.filter_top is not None:
+            for param in filter_params[1:]:
+                if len(getattr(self, param)) != len(self.filter_top):
+                    raise ValueError(f"All filter parameters must have the same number of elements. '{param}' has {len(getattr(self, param))} elements, but 'filter_top' has {len(self.filter_top)} elements.")
+
+        # Sort list params so the same query always has the same key. The filter lists are parallel, so they keep
+        # their order.
+        for param in list_params:
+            value = getattr(self, param)
+            if value is not None and param not in filter_params:
+                msgspec.structs.force_setattr(self, param, tuple(sorted(value)))
+
+    @cached_property
+    def params(self):
+        """
+        The normalized params, which select the stats that are computed and cached. The player/team scope,
+        sorting and the minimum PA/IP are applied to the stats afterwards, so they are not part of them.
+        """
+        # Queries without years are for the latest season, so the current season once its first games are in
+        default_year = latest_year()
+        params = {
+            "type": self.type,
+            "start_year": default_year if self.start_year is None else self.start_year,
+            "end_year": default_year if self.end_year is None else self.end_year,
+            "split": self.split,
+            "find": self.find,
+        }
+        for param in optional_params:
+            value = getattr(self, param)
+            if value is None:
+                continue
+            if param in yes_no_params:
+                value = value == "Y"
+            elif param == "filter_top":
+                value = [top == "Y" for top in value]
+            elif param in list_params:
+                value = list(value)
+            params[param] = value
+        return params
+
+    @property
+    def min_value(self):
+        return self.min_pa if self.type == "batting" else self.min_ip
+
+    @property
+    def scope(self):
+        """
+        The (column, value) the results are limited to when the query is for a single player or team, otherwise None.
+        """
+        if self.player_id is not None:
+            return ("player_id", self.player_id)
+        if self.team is not None:
+            return ("team", self.team)
+        return None
+
+    @property
+    def since_versions(self):
+        """
+        The data versions of since_version as a dict of year to version, or None if the query is not for a delta.
+        """
+        return None if self.since_version is None else parse_version_token(self.since_version)
+
+    @cached_property
+    def key(self):
+        """
+        A hash of everything that decides the results of the query.
+        """
+        return sha1(json.encode([self.params, self.scope, self.sort, self.min_value], order="deterministic")).digest()
+
+
+list_params = [
+    "days_of_week",
+    "batter_lineup_pos",
+    "player_field_position",
+    "pitching_team",
+    "batting_team",
+    "innings",
+    "outs",
+    "count",
+    "strikes",
+    "balls",
+    "score_diff",
+    "home_score",
+    "away_score",
+    "base_situation",
+    "filter_innings",
+    "filter_top",
+    "filter_stats",
+    "filter_values",
+    "filter_operators",
+]
+yes_no_params = ["batter_starter", "pitcher_starter", "batter_home", "pitcher_home", "filter_opposing"]
+optional_params = [field for field in Query.__struct_fields__ if field not in ("type", "start_year", "end_year", "split", "find", "player_id", "team", "sort", "min_pa", "min_ip", "since_version")]
+
+error_messages = {
+    "type": "'type' in params must be either 'batting' or 'pitching'.",
+    "start_year": "start_year and end_year must be integers",
+    "end_year": "start_year and end_year must be integers",
+    "split": "split must be either 'year', 'career', 'month', or 'game'",
+    "find": "find must be either 'player' or 'team'",
+    "days_of_week": f"days_of_week must be one or more of {', '.join(valid_days)}",
+    "batter_handedness_pa": "batter_handedness_pa must be 'L', or 'R'",
+    "pitcher_handedness": "pitcher_handedness must be 'L', or 'R'",
+    "batter_starter": "batter_starter must be 'Y' or 'N'",
+    "pitcher_starter": "pitcher_starter must be 'Y' or 'N'",
+    "batter_lineup_pos": "batter_lineup_pos must be a comma-separated list of integers from 1 to 9",
+    "player_field_position": "player_field_position must be a comma-separated list of integers from 1 to 12",
+    "batter_home": "batter_home must be 'Y' or 'N'",
+    "pitcher_home": "pitcher_home must be 'Y' or 'N'",
+    "pitching_team": "pitching_team must be a comma-separated list of 3-letter uppercase team codes",
+    "batting_team": "batting_team must be a comma-separated list of 3-letter uppercase team codes",
+    "innings": "innings must be a comma-separated list of integers greater than or equal to 1",
+    "outs": "outs must be a comma-separated list of integers from 0 to 2",
+    "count": "count must be a comma-separated list of strings in the format 'strikes-balls' (e.g., '2-1'), with strikes between 0 and 2 and balls between 0 and 3",
+    "strikes": "strikes must be a comma-separated list of integers from 0 to 3",
+    "balls": "balls must be a comma-separated list of integers from 0 to 4",
+    "score_diff": "score_diff must be a comma-separated list of integers",
+    "home_score": "home_score must be a comma-separated list of non-negative integers",
+    "away_score": "away_score must be a comma-separated list of non-negative integers",
+    "base_situation": "base_situation must be a comma-separated list of integers from 0 to 7",
+    "filter_home": "filter_home must be 'home', 'away', or 'either'",
+    "filter_opposing": "filter_opposing must be 'Y' or 'N'",
+    "filter_innings": "filter_innings must be a comma-separated list of integers greater than or equal to 1",
+    "filter_top": "filter_top must be a comma-separated list of 'Y' or 'N' values",
+    "filter_stats": f"filter_stats must be a comma-separated list of valid columns: {', '.join(valid_filter_cols)}",
+    "filter_values": "filter_values must be a comma-separated list of integers",
+    "filter_operators": f"filter_operators must be a comma-separated list of valid operators: {', '.join(valid_operators)}",
+    "team": "team must be a 3-letter uppercase team code",
+    "sort": "sort must be a comma-separated list of fields",
+    "min_pa": "min_pa must be an integer",
+    "min_ip": "min_ip must be an integer",
+    "since_version": "since_version must be a token from the X-Data-Version header of a stat response",
+}
+
+error_field = re.compile(r"at `\$\.([^`\[]+)")
+
+
+def parse_query(data, stat_type=None):
+    """
+    Decodes and validates a stat query.
+
+    Args:
+        data: The query params of a request, or the params of a saved query. Lists can be given as lists or as
+            comma separated strings, and Y/N params as "Y"/"N" or booleans. Empty values are ignored.
+        stat_type: Either "batting" or "pitching", which overrides any type in data.
+
+    Returns:
+        The Query.
+    """
+    raw = {}
+    for param, value in data.items():
+        if value is None or value == "" or value == []:
+            continue
+        if isinstance(value, bool):
+            value = "Y" if value else "N"
+        elif param in list_params and isinstance(value, str):
+            value = value.split(",")
+        raw[param] = value
+    if stat_type is not None:
+        raw["type"] = stat_type
+    try:
+        return msgspec.convert(raw, Query, strict=False)
+    except msgspec.ValidationError as e:
+        match = error_field.search(str(e))
+        if match and match.group(1) in error_messages:
+            raise ValidationError(error_messages[match.group(1)])
+        raise ValidationError(str(e))
@@ -0,0 +1,39 @@
+# Columns that do not apply to every split (e.g. team when finding players). Missing values in these columns are
+# sent as "N/A", and missing values in any other column as "NaN".
+nullable_cols = ["year", "player_id", "team", "month", "day", "game_id", "start_year", "end_year", "win", "loss"]
+
+
+def to_records(stats):
+    """
+    Converts a stats DataFrame into a list of rows, keeping numbers as numbers and missing values as None.
+
+    Args:
+        stats: The stats DataFrame, with NaN for missing values.
+
+    Returns:
+        A list of dicts, one per row.
+    """
+    missing = stats.isna()
+    # Only columns with missing values need to become object columns, the rest keep their dtype
+    cols = missing.columns[missing.any()]
+    if len(cols):
+        stats = stats.astype({col: object for col in cols})
+        stats[cols] = stats[cols].where(~missing[cols], None)
+    return stats.to_dict(orient="records")
+
+
+def fill_sentinels(rows):
+    """
+    Replaces missing values with the strings the API has always sent in their place. Only done for the rows
+    that are about to be sent, so everything before that works with typed values.
+
+    Args:
+        rows: The rows to send.
+
+    Returns:
+        New rows, with "N/A" or "NaN" in place of None.
+    """
+    return [
+        {col: ("N/A" if col in nullable_cols else "NaN") if value is None else value for col, value in row.items()}
+        for row in rows
+    ]
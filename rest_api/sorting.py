@@ -0,0 +1,115 @@
+import heapq
+from itertools import islice
+
+non_numeric_fields = ["player_id", "team", "game_id"]
+
+
+def parse_sort(sort):
+    return [(field.lstrip("-"), field.startswith("-")) for field in sort.split(",")]
+
+
+def field_key(field, negative):
+    if field in non_numeric_fields:
+        # Missing ids sort where the "N/A" that is sent in their place would
+        return lambda x: "N/A" if x[field] is None else x[field]
+    # Missing values always go to the end, whichever way the field is sorted
+    missing = float("-inf") if negative else float("inf")
+    return lambda x: missing if x[field] is None else x[field]
+
+
+def check_fields(stats, sort):
+    for field, _ in parse_sort(sort):
+        if field not in stats[0]:
+            raise ValueError(f"Field '{field}' not found in stats")
+
+
+def sort_stats(stats, sort):
+    """
+    Sorts a list of stat rows in place by a comma separated list of fields, each optionally prefixed with '-'.
+
+    Args:
+        stats: A non-empty list of stat rows.
+        sort: The sort string, e.g. "year,player_id" or "-HR".
+    """
+    check_fields(stats, sort)
+    for field, negative in reversed(parse_sort(sort)):
+        stats.sort(key=field_key(field, negative), reverse=negative)
+
+
+def sort_permutation(stats, sort):
+    """
+    Computes the order sort_stats would put a list of stat rows in without moving the rows.
+
+    Args:
+        stats: A non-empty list of stat rows.
+        sort: The sort string.
+
+    Returns:
+        A list of indexes into stats, in sorted order.
+    """
+    check_fields(stats, sort)
+    order = list(range(len(stats)))
+    for field, negative in reversed(parse_sort(sort)):
+        key = field_key(field, negative)
+        order.sort(key=lambda i: key(stats[i]), reverse=negative)
+    return order
+
+
+def is_mergeable(sort):
+    # heapq.merge only takes a single direction for the whole key
+    return len({negative for _, negative in parse_sort(sort)}) == 1
+
+
+class MergedStats:
+    """
+    A read-only sequence over several individually sorted lists of stat rows.
+
+    The lists are merged lazily with heapq.merge, so paginating only merges the rows up to the end of the
+    requested page instead of sorting every row of every year.
+    """
+
+    def __init__(self, chunks, sort):
+        keys = [field_key(field, negative) for field, negative in parse_sort(sort)]
+        self.length = sum(len(chunk) for chunk in chunks)
+        self.merged = []
+        self.rows = heapq.merge(
+            *chunks,
+            key=lambda x: tuple(key(x) for key in keys),
+            reverse=parse_sort(sort)[0][1],
+        )
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        start, stop = (index.start, index.stop) if isinstance(index, slice) else (index, index + 1)
+        if stop is None or stop <= 0 or (start or 0) < 0:
+            stop = self.length
+        if stop > len(self.merged):
+            self.merged.extend(islice(self.rows, stop - len(self.merged)))
+        return self.merged[index]
+
+
+def sort_chunks(chunks, presorted, sort):
+    """
+    Sorts stats made up of several lists of rows, some of which may already be sorted.
+
+    Args:
+        chunks: Non-empty lists of stat rows, e.g. one per cached year.
+        presorted: For each chunk, whether it is already in the requested order.
+        sort: The sort string.
+
+    Returns:
+        A sequence of all the rows in sorted order.
+    """
+    check_fields(chunks[0], sort)
+    if not is_mergeable(sort) or not any(presorted):
+        stats = [row for chunk in chunks for row in chunk]
+        sort_stats(stats, sort)
+        return stats
+    for chunk, chunk_presorted in zip(chunks, presorted):
+        if not chunk_presorted:
+            sort_stats(chunk, sort)
+    if len(chunks) == 1:
+        return chunks[0]
+    return MergedStats(chunks, sort)
@@ -1,3 +1,425 @@
-from django.test import TestCase
+import io
+import tempfile
+from hashlib import sha1
+from unittest import mock
 
-# Create your tests here.
+import msgspec.msgpack as msgpack
+import pandas as pd
+from django.test import SimpleTestCase
+from rest_framework.exceptions import ValidationError
+
+from rest_api.cache import QueryCache
+from rest_api.cache_backends import CacheEntry, LMDBBackend, MemoryBackend, RedisBackend, RedisError, SharedEntry, TieredBackend
+from rest_api.compaction import copy_filtered
+from rest_api.hot_cache import HotCache
+from rest_api.query import error_messages, parse_query
+from rest_api.sorting import MergedStats, sort_chunks, sort_stats
+from rest_api.versions import set_year_versions
+from rest_api.views import diff_rows, get_delta
+
+
+def make_entry(key, years, version=1):
+    return CacheEntry(key, b"[]", years, {}, {}, [version] * len(years))
+
+
+class FailingBackend(MemoryBackend):
+    def delete_year(self, year, before_version=None):
+        raise ConnectionRefusedError
+
+
+class CannedSocket:
+    def __init__(self):
+        self.sent = b""
+
+    def sendall(self, data):
+        self.sent += data
+
+    def close(self):
+        pass
+
+
+def canned_backend(replies):
+    # A RedisBackend that reads the given replies instead of talking to a server
+    backend = RedisBackend("localhost", 6379)
+    backend.sock, backend.reader = CannedSocket(), io.BytesIO(replies)
+    return backend
+
+
+def bulk(value):
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class RedisBackendTests(SimpleTestCase):
+    def test_read_reply(self):
+        backend = canned_backend(b"+OK\r\n:42\r\n$5\r\nhe\r\no\r\n$-1\r\n$0\r\n\r\n*3\r\n$1\r\na\r\n:-1\r\n*1\r\n$-1\r\n*0\r\n*-1\r\n")
+
+        self.assertEqual(backend.read_reply(), b"OK")
+        self.assertEqual(backend.read_reply(), 42)
+        self.assertEqual(backend.read_reply(), b"he\r\no")
+        self.assertIsNone(backend.read_reply())
+        self.assertEqual(backend.read_reply(), b"")
+        self.assertEqual(backend.read_reply(), [b"a", -1, [None]])
+        self.assertEqual(backend.read_reply(), [])
+        self.assertIsNone(backend.read_reply())
+
+    def test_read_reply_errors(self):
+        backend = canned_backend(b"-ERR unknown command\r\n?\r\n")
+
+        with self.assertRaisesMessage(RedisError, "ERR unknown command"):
+            backend.read_reply()
+        with self.assertRaisesMessage(RedisError, "Unexpected reply"):
+            backend.read_reply()
+        with self.assertRaises(ConnectionError):
+            backend.read_reply()
+
+    def test_get_entries(self):
+        current = msgpack.encode(SharedEntry(b"[]", [2024, 2025], {"-OPS": b"\x00"}, {"team:BOS": b"[]"}, [3, 4]))
+        # Stored before data versions were recorded
+        old = msgpack.encode([b"[]", [2024], {}, {}])
+        backend = canned_backend(b"*3\r\n" + bulk(current) + b"$-1\r\n" + bulk(old))
+
+        self.assertEqual(backend.get_entries([b"a", b"b", b"c"]), [
+            CacheEntry(b"a", b"[]", [2024, 2025], {"-OPS": b"\x00"}, {"team:BOS": b"[]"}, [3, 4]),
+            None,
+            CacheEntry(b"c", b"[]", [2024], {}, {}, [0]),
+        ])
+        self.assertEqual(backend.sock.sent, b"*4\r\n$4\r\nMGET\r\n" + b"".join(bulk(b"baseballquery:entry:" + key) for key in (b"a", b"b", b"c")))
+
+    def test_unexpected_reply(self):
+        backend = canned_backend(b":1\r\n")
+
+        with self.assertRaisesMessage(RedisError, "Unexpected reply 1 to MGET"):
+            backend.get_entries([b"a"])
+
+
+class TieredBackendTests(SimpleTestCase):
+    def test_shared_hit_is_copied_into_local(self):
+        local, shared = MemoryBackend(), MemoryBackend()
+        backend = TieredBackend(local, shared)
+        shared.put_entries([make_entry(b"a", [2024])])
+
+        self.assertEqual(backend.get_values([b"a", b"b"]), [b"[]", None])
+        self.assertEqual(local.get_values([b"a"]), [b"[]"])
+
+    def test_put_is_written_behind_to_shared(self):
+        local, shared = MemoryBackend(), MemoryBackend()
+        backend = TieredBackend(local, shared)
+        backend.put_entries([make_entry(b"a", [2024])])
+        backend.close()
+
+        self.assertEqual(shared.get_values([b"a"]), [b"[]"])
+
+    def test_delete_year(self):
+        local, shared = MemoryBackend(), MemoryBackend()
+        backend = TieredBackend(local, shared)
+        backend.put_entries([make_entry(b"a", [2024]), make_entry(b"b", [2025]), make_entry(b"c", [2024, 2025])])
+        backend.delete_year(2025)
+
+        for tier in (local, shared):
+            self.assertEqual(tier.get_values([b"a", b"b", b"c"]), [b"[]", None, None])
+
+    def test_delete_year_keeps_newer_versions(self):
+        local, shared = MemoryBackend(), MemoryBackend()
+        backend = TieredBackend(local, shared)
+        backend.put_entries([make_entry(b"old", [2025], 1), make_entry(b"previous", [2025], 2)])
+        backend.delete_year(2025, before_version=2)
+
+        for tier in (local, shared):
+            self.assertEqual(tier.get_values([b"old", b"previous"]), [None, b"[]"])
+
+    def test_delete_year_with_shared_down(self):
+        local = MemoryBackend()
+        backend = TieredBackend(local, FailingBackend())
+        local.put_entries([make_entry(b"a", [2024])])
+
+        with self.assertLogs("rest_api.cache_backends", "ERROR"):
+            backend.delete_year(2024)
+        self.assertEqual(local.get_values([b"a"]), [None])
+
+
+# An invalid value for each param with an error message
+invalid_values = {
+    "type": "fielding",
+    "start_year": "x",
+    "end_year": "x",
+    "split": "week",
+    "find": "league",
+    "days_of_week": "Funday",
+    "batter_handedness_pa": "S",
+    "pitcher_handedness": "S",
+    "batter_starter": "X",
+    "pitcher_starter": "X",
+    "batter_lineup_pos": "10",
+    "player_field_position": "13",
+    "batter_home": "X",
+    "pitcher_home": "X",
+    "pitching_team": "bos",
+    "batting_team": "BOS,bos",
+    "innings": "0",
+    "outs": "3",
+    "count": "3-0",
+    "strikes": "4",
+    "balls": "5",
+    "score_diff": "x",
+    "home_score": "-1",
+    "away_score": "-1",
+    "base_situation": "8",
+    "filter_home": "both",
+    "filter_opposing": "X",
+    "filter_innings": "0",
+    "filter_top": "X",
+    "filter_stats": "XYZ",
+    "filter_values": "x",
+    "filter_operators": "==",
+    "team": "bos",
+    "sort": 1,
+    "min_pa": "x",
+    "min_ip": "x",
+    "since_version": "x",
+}
+
+filter_data = {
+    "filter_opposing": "Y",
+    "filter_innings": "9,1",
+    "filter_top": "N,Y",
+    "filter_stats": "HR,H",
+    "filter_values": "1,0",
+    "filter_operators": ">=,=",
+}
+
+
+class ParseQueryTests(SimpleTestCase):
+    def assertInvalid(self, data, message):
+        with self.assertRaises(ValidationError) as context:
+            parse_query(data)
+        self.assertEqual(context.exception.detail, [message])
+
+    def test_error_messages(self):
+        self.assertEqual(invalid_values.keys(), error_messages.keys())
+        for param, message in error_messages.items():
+            with self.subTest(param=param):
+                self.assertInvalid({"type": "batting", param: invalid_values[param]}, message)
+
+    def test_cross_param_errors(self):
+        self.assertInvalid({"type": "batting", "start_year": "2024"}, "end_year must be provided if start_year is provided")
+        self.assertInvalid({"type": "batting", "end_year": "2024"}, "start_year must be provided if end_year is provided")
+        self.assertInvalid({"type": "batting", "start_year": "2025", "end_year": "2024"}, "start_year cannot be greater than end_year")
+        self.assertInvalid({"type": "batting", "player_id": "ortid001", "team": "BOS"}, "Only one of player_id and team can be given")
+        self.assertInvalid({"type": "batting", "filter_opposing": "Y"}, "The filter feature requires all of filter_opposing, filter_innings, filter_top, filter_stats, filter_values, and filter_operators to be specified")
+        self.assertInvalid({"type": "batting", **filter_data, "filter_values": "1"}, "All filter parameters must have the same number of elements. 'filter_values' has 1 elements, but 'filter_top' has 2 elements.")
+
+    def test_list_normalization(self):
+        query = parse_query({"type": "batting", "start_year": "2024", "end_year": "2024", "innings": "9,1,5", "pitching_team": "NYY,BOS", **filter_data})
+
+        self.assertEqual(query.innings, (1, 5, 9))
+        self.assertEqual(query.pitching_team, ("BOS", "NYY"))
+        # The filter lists are parallel, so they keep their order
+        self.assertEqual(query.filter_innings, (9, 1))
+        self.assertEqual(query.params["innings"], [1, 5, 9])
+        self.assertEqual(query.params["filter_top"], [False, True])
+        self.assertEqual(query, parse_query({"type": "batting", "start_year": "2024", "end_year": "2024", "innings": "1,5,9", "pitching_team": "BOS,NYY", **filter_data}))
+
+    def test_yes_no_normalization(self):
+        query = parse_query({"type": "batting", "start_year": "2024", "end_year": "2024", "batter_home": "Y", "pitcher_starter": "N"})
+
+        self.assertEqual(query.batter_home, "Y")
+        self.assertIs(query.params["batter_home"], True)
+        self.assertIs(query.params["pitcher_starter"], False)
+
+    def test_saved_query_payload(self):
+        payload = {
+            "type": "pitching",
+            "start_year": 2023,
+            "end_year": 2024,
+            "innings": [7, 8],
+            "days_of_week": ["Sunday", "Monday"],
+            "batter_home": True,
+            "pitcher_starter": False,
+            "balls": [],
+            "count": "",
+            "team": None,
+            "min_ip": 50,
+        }
+        query = parse_query(payload)
+
+        self.assertEqual(query, parse_query({"type": "pitching", "start_year": "2023", "end_year": "2024", "innings": "8,7", "days_of_week": "Monday,Sunday", "batter_home": "Y", "pitcher_starter": "N", "min_ip": "50"}))
+        self.assertIsNone(query.balls)
+        self.assertIsNone(query.team)
+        self.assertEqual(query.min_value, 50)
+
+    def test_stat_type_overrides_type(self):
+        self.assertEqual(parse_query({"type": "pitching"}, "batting").type, "batting")
+        self.assertEqual(parse_query({}, "pitching").type, "pitching")
+
+
+def stat_rows(year, hrs):
+    return [{"player_id": f"p{year}{i}", "year": year, "HR": hr, "AVG": 0.25} for i, hr in enumerate(hrs)]
+
+
+def sorted_rows(rows, sort):
+    rows = list(rows)
+    sort_stats(rows, sort)
+    return rows
+
+
+class SortingTests(SimpleTestCase):
+    def test_merge_matches_full_sort(self):
+        chunks = [stat_rows(2023, [10, None, 30, 10]), stat_rows(2024, [30, 10, None]), stat_rows(2025, [10, 20])]
+        for sort in ["-HR", "HR", "-HR,-AVG", "HR,player_id", "-player_id"]:
+            with self.subTest(sort=sort):
+                expected = sorted_rows([row for chunk in chunks for row in chunk], sort)
+                merged = sort_chunks([sorted_rows(chunk, sort) for chunk in chunks], [True, True, True], sort)
+                partly = sort_chunks([sorted_rows(chunks[0], sort), list(chunks[1]), list(chunks[2])], [True, False, False], sort)
+
+                self.assertEqual(list(merged), expected)
+                self.assertEqual(list(partly), expected)
+
+    def test_ties_keep_chunk_order(self):
+        chunks = [stat_rows(2023, [10, 10]), stat_rows(2024, [10]), stat_rows(2025, [10])]
+        for sort in ["HR", "-HR"]:
+            with self.subTest(sort=sort):
+                merged = MergedStats(chunks, sort)
+                self.assertEqual([row["player_id"] for row in merged[:4]], ["p20230", "p20231", "p20240", "p20250"])
+
+    def test_missing_values_go_last(self):
+        chunks = [stat_rows(2024, [None, 5]), stat_rows(2025, [None, 1])]
+        for sort in ["HR", "-HR"]:
+            with self.subTest(sort=sort):
+                merged = sort_chunks([sorted_rows(chunk, sort) for chunk in chunks], [True, True], sort)
+                self.assertEqual([row["HR"] for row in merged[:4]][2:], [None, None])
+
+    def test_slicing(self):
+        chunks = [stat_rows(2024, [9, 7, 5, 3, 1]), stat_rows(2025, [8, 6, 4, 2])]
+        merged = MergedStats(chunks, "-HR")
+        expected = sorted_rows(chunks[0] + chunks[1], "-HR")
+
+        self.assertEqual(len(merged), 9)
+        self.assertEqual(merged[3:6], expected[3:6])
+        self.assertEqual(merged[0], expected[0])
+        self.assertEqual(merged[0:2], expected[0:2])
+        self.assertEqual(merged[7:20], expected[7:])
+        self.assertEqual(merged[5:], expected[5:])
+        self.assertEqual(merged[-1], expected[-1])
+        self.assertEqual(merged[:], expected)
+
+    def test_presorted_permutation(self):
+        stats = pd.DataFrame(stat_rows(2024, [5, None, 40, 12]) + stat_rows(2025, [7, 33]))
+        params = {"type": "batting", "start_year": 2024, "end_year": 2025, "split": "year", "find": "player"}
+        fresh = stat_rows(2026, [20, None])
+        for hot in [None, HotCache(1024 * 1024, 60)]:
+            with self.subTest(hot=hot is not None), tempfile.TemporaryDirectory() as path, self.settings(DATA_VERSIONS_PATH=f"{path}/versions.json"):
+                cache = QueryCache(f"{path}/cache", sort_keys=["-HR"], hot=hot)
+                self.addCleanup(cache.close)
+                cache.put_data(params, stats, {2024, 2025})
+                if hot is not None:
+                    # Read the entries from the backend into the hot cache
+                    hot.clear()
+                    cache.get_chunks(params)
+                chunks, presorted, years = cache.get_chunks(params, "-HR")
+
+                self.assertEqual(years, {2024, 2025})
+                self.assertEqual(presorted, [True, True])
+                self.assertEqual([[row["HR"] for row in chunk] for chunk in chunks], [[40.0, 12.0, 5.0, None], [33.0, 7.0]])
+                stats_rows = sort_chunks(chunks + [list(fresh)], presorted + [False], "-HR")
+                self.assertEqual([row["player_id"] for row in stats_rows[:8]], ["p20242", "p20251", "p20260", "p20243", "p20250", "p20240", "p20241", "p20261"])
+
+
+def batting_row(player_id, year, PA, HR, team="BOS"):
+    return {"player_id": player_id, "team": team, "year": year, "PA": PA, "HR": HR}
+
+
+class DeltaTests(SimpleTestCase):
+    def test_diff_rows(self):
+        old = [batting_row("a", 2025, 100, 5), batting_row("b", 2025, 100, 5), batting_row("c", 2025, 100, 5)]
+        new = [batting_row("d", 2025, 10, 1), batting_row("b", 2025, 104, 6), batting_row("a", 2025, 100, 5)]
+        added, changed, removed = diff_rows(old, new)
+
+        self.assertEqual(added, [new[0]])
+        self.assertEqual(changed, [new[1]])
+        self.assertEqual(removed, [{"player_id": "c", "team": "BOS", "year": 2025}])
+
+    def test_diff_rows_by_split(self):
+        # Rows of the same player in different games are different rows
+        old = [{"player_id": "a", "game_id": "g1", "HR": 1}]
+        new = [{"player_id": "a", "game_id": "g1", "HR": 1}, {"player_id": "a", "game_id": "g2", "HR": 0}]
+
+        self.assertEqual(diff_rows(old, new), ([new[1]], [], []))
+
+    def test_get_delta(self):
+        params = {"type": "batting", "start_year": 2024, "end_year": 2025, "split": "year", "find": "player"}
+        stats_2024 = [batting_row("a", 2024, 600, 30), batting_row("b", 2024, 500, 20)]
+        old = pd.DataFrame(stats_2024 + [batting_row("a", 2025, 100, 5), batting_row("b", 2025, 100, 3), batting_row("c", 2025, 60, 1, "NYY")])
+        # 2024 did not change, so its rows are not even read: changing them here shows they are not diffed
+        new = pd.DataFrame([batting_row("a", 2024, 600, 31)] + [batting_row("a", 2025, 104, 6), batting_row("b", 2025, 100, 3), batting_row("d", 2025, 55, 2), batting_row("c", 2025, 40, 1, "NYY")])
+        with tempfile.TemporaryDirectory() as path, self.settings(DATA_VERSIONS_PATH=f"{path}/versions.json"):
+            cache = QueryCache(f"{path}/cache")
+            self.addCleanup(cache.close)
+            set_year_versions({2024: 7, 2025: 1})
+            cache.put_data(params, old, {2024, 2025})
+            set_year_versions({2025: 2})
+            cache.put_data(params, new.iloc[1:], {2025})
+            query = {"type": "batting", "start_year": "2024", "end_year": "2025", "since_version": "2024:7,2025:1", "sort": "-HR"}
+
+            with mock.patch("rest_api.views.get_query_cache", return_value=cache):
+                added, changed, removed = get_delta(parse_query(query))
+                self.assertEqual(added, [batting_row("d", 2025, 55, 2)])
+                self.assertEqual(changed, [batting_row("a", 2025, 104, 6), batting_row("c", 2025, 40, 1, "NYY")])
+                self.assertEqual(removed, [])
+
+                # Rows that fall below the minimum are removed
+                added, changed, removed = get_delta(parse_query({**query, "min_pa": "50"}))
+                self.assertEqual([row["player_id"] for row in added + changed], ["d", "a"])
+                self.assertEqual(removed, [{"player_id": "c", "team": "NYY", "year": 2025}])
+
+                _, changed, removed = get_delta(parse_query({**query, "team": "NYY", "min_pa": "50"}))
+                self.assertEqual((changed, len(removed)), ([], 1))
+
+                # Versions whose stats are no longer cached
+                self.assertIsNone(get_delta(parse_query({**query, "since_version": "2024:7,2025:0"})))
+
+
+def year_records(backend):
+    with backend.env.begin() as txn:
+        return [(key, int.from_bytes(value[:2]), int.from_bytes(value[2:])) for key, value in txn.cursor(db=backend.years)]
+
+
+class CopyFilteredTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.source = LMDBBackend(f"{directory.name}/source", 1024 * 1024 * 1024)
+        self.target = LMDBBackend(f"{directory.name}/target", 1024 * 1024 * 1024)
+        self.addCleanup(self.source.close)
+        self.addCleanup(self.target.close)
+        self.keys = {name: sha1(name.encode()).digest() for name in ["2024", "2025", "career", "other career"]}
+        self.source.put_entries([
+            CacheEntry(self.keys["2024"], b"a", [2024], {"-HR": b"\x01"}, {"team:BOS": b"ai"}, [4]),
+            CacheEntry(self.keys["2025"], b"b", [2025], {"-HR": b"\x02"}, {"team:BOS": b"bi"}, [5]),
+            CacheEntry(self.keys["career"], b"c", [2022, 2023, 2024], {"-HR": b"\x03"}, {"team:BOS": b"ci", "team:NYY": b"cj"}, [2, 3, 4]),
+            CacheEntry(self.keys["other career"], b"d", [2024, 2025], {}, {}, [4, 5]),
+        ])
+        self.source.put_pages({b"page": b"p"})
+
+    def test_copy_everything(self):
+        self.assertEqual(copy_filtered(self.source, self.target, set()), 0)
+
+        keys = list(self.keys.values())
+        self.assertEqual(self.target.get_values(keys), [b"a", b"b", b"c", b"d"])
+        self.assertEqual(self.target.get_orders(keys, "-HR"), [b"\x01", b"\x02", b"\x03", None])
+        self.assertEqual(self.target.get_index(keys, "team:NYY"), [b"", b"", b"cj", b""])
+        self.assertEqual(year_records(self.target), year_records(self.source))
+        self.assertEqual(len(year_records(self.target)), 7)
+        self.assertEqual(self.target.get_page(b"page"), b"p")
+
+    def test_drop_years(self):
+        self.assertEqual(copy_filtered(self.source, self.target, {2025}), 2)
+
+        keys = list(self.keys.values())
+        self.assertEqual(self.target.get_values(keys), [b"a", None, b"c", None])
+        self.assertEqual(self.target.get_orders(keys, "-HR"), [b"\x01", None, b"\x03", None])
+        self.assertEqual(self.target.get_index(keys, "team:BOS"), [b"ai", None, b"ci", None])
+        # Every year of a kept career entry is copied, so deleting any of them still finds it
+        self.assertEqual(year_records(self.target), [record for record in year_records(self.source) if record[0] in (self.keys["2024"], self.keys["career"])])
+        self.target.delete_year(2022)
+        self.assertEqual(self.target.get_values([self.keys["career"]]), [None])
+        self.assertEqual(self.target.get_page(b"page"), b"p")
@@ -5,4 +5,6 @@ urlpatterns = [
     path('batting_stats', views.BattingStatQuery.as_view(), name='batting_stat_query'),
     path('pitching_stats', views.PitchingStatQuery.as_view(), name='pitching_stat_query'),
     path('saved_query', views.SavedQueries.as_view(), name='saved_query'),
+    path('cache_stats', views.CacheStats.as_view(), name='cache_stats'),
+    path('profiles', views.Profiles.as_view(), name='profiles'),
 ]
\ No newline at end of file
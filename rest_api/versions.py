@@ -0,0 +1,79 @@
+import os
+
+import msgspec.json as json
+from django.conf import settings
+
+# The data version of each year is the number of events ingested for it, which only grows during a season
+# and is the same on every node that ingested the same games. Years that are not in the file are version 0.
+loaded_versions = {}
+loaded_mtime = None
+
+
+def get_versions():
+    """
+    Gets the data version of every year that has one, rereading the versions file only when it changed.
+
+    Returns:
+        A dict of year to data version.
+    """
+    global loaded_versions, loaded_mtime
+    try:
+        mtime = os.stat(settings.DATA_VERSIONS_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    if mtime != loaded_mtime:
+        with open(settings.DATA_VERSIONS_PATH, "rb") as f:
+            loaded_versions = {int(year): version for year, version in json.decode(f.read()).items()}
+        loaded_mtime = mtime
+    return loaded_versions
+
+
+def get_year_versions(start_year, end_year):
+    versions = get_versions()
+    return {year: versions[year] for year in range(start_year, end_year + 1) if year in versions}
+
+
+def set_year_versions(new_versions):
+    """
+    Sets the data versions of some years, in one write.
+
+    Args:
+        new_versions: A dict of year to data version.
+    """
+    versions = {**get_versions(), **new_versions}
+    # Write to a temporary file first so readers never see a partially written file
+    tmp_path = f"{settings.DATA_VERSIONS_PATH}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(json.encode({str(year): version for year, version in sorted(versions.items())}))
+    os.replace(tmp_path, settings.DATA_VERSIONS_PATH)
+
+
+def version_token(versions):
+    """
+    Encodes the data versions a response was computed from as the token clients send back as since_version.
+
+    Args:
+        versions: A dict of year to data version, from get_year_versions.
+    """
+    return ",".join(f"{year}:{version}" for year, version in sorted(versions.items())) or "0"
+
+
+def parse_version_token(token):
+    """
+    Decodes a token from version_token.
+
+    Returns:
+        A dict of year to data version.
+
+    Raises:
+        ValueError: If the token is not valid.
+    """
+    if token == "0":
+        return {}
+    versions = {}
+    for part in token.split(","):
+        year, _, version = part.partition(":")
+        if not year.isdigit() or not version.isdigit():
+            raise ValueError("since_version must be a token from the X-Data-Version header of a stat response")
+        versions[int(year)] = int(version)
+    return versions
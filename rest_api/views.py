@@ -2,166 +2,39 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.exceptions import ValidationError, NotFound
+from rest_framework.permissions import IsAdminUser
 import baseballquery
 import numpy as np
 from rest_api.models import SavedQuery
-from rest_api.cache import QueryCache
+from rest_api.cache import get_query_cache
+from rest_api import admission, dataset, leaderboards, profiling
+from rest_api.compression import compress_response
+from rest_api.query import parse_query
+from rest_api.serialization import fill_sentinels, to_records
+from rest_api.sorting import sort_chunks
+from rest_api.versions import get_year_versions, version_token
+from django.conf import settings
 from django.core.exceptions import ValidationError as DjangoValidationError
-from copy import deepcopy
-
-filter_params = ["filter_opposing", "filter_innings", "filter_top", "filter_stats", "filter_values", "filter_operators"]
-
-nullable_cols = ["year", "player_id", "team", "month", "day", "game_id", "start_year", "end_year", "win", "loss"]
-
-split_params = [
-    # "start_year",
-    # "end_year",
-    # "split",
-    # "find",
-    # "days_of_week",
-    "batter_handedness_pa",
-    "pitcher_handedness",
-    "batter_starter",
-    "pitcher_starter",
-    "batter_home",
-    "pitcher_home",
-    # "pitching_team",
-    # "batting_team",
-    # "innings",
-    # "outs",
-    # "strikes",
-    # "balls",
-    # "score_diff",
-    # "home_score",
-    # "away_score",
-    # "base_situation",
-    "filter_home",
-    "filter_opposing",
-]
-
-list_params_type_func = {
-    "days_of_week": str,
-    "pitching_team": str,
-    "batting_team": str,
-    "innings": int,
-    "outs": int,
-    "count": str,
-    "strikes": int,
-    "balls": int,
-    "score_diff": int,
-    "home_score": int,
-    "away_score": int,
-    "base_situation": int,
-    "batter_lineup_pos": int,
-    "player_field_position": int,
-    "filter_innings": int,
-    "filter_top": str,
-    "filter_stats": str,
-    "filter_values": int,
-    "filter_operators": str,
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+import msgspec.json as json
+from hashlib import sha1
+from contextlib import nullcontext
+from datetime import datetime
+
+stat_splits_classes = {
+    "batting": baseballquery.BattingStatSplits,
+    "pitching": baseballquery.PitchingStatSplits,
 }
 
-bool_params = [
-    "batter_home",
-    "pitcher_home",
-    "batter_starter",
-    "pitcher_starter",
-    "filter_opposing"
-]
-
-valid_filter_cols = [
-    "AB_FL",
-    "H_CD",
-    "SH_FL",
-    "SF_FL",
-    "EVENT_OUTS_CT",
-    "DP_FL",
-    "TP_FL",
-    "RBI_CT",
-    "WP_FL",
-    "PB_FL",
-    "BATTEDBALL_CD",
-    "BAT_DEST_ID",
-    "RUN1_DEST_ID",
-    "RUN2_DEST_ID",
-    "RUN3_DEST_ID",
-    "RUN1_SB_FL",
-    "RUN2_SB_FL",
-    "RUN3_SB_FL",
-    "RUN1_CS_FL",
-    "RUN2_CS_FL",
-    "RUN3_CS_FL",
-    "RUN1_PK_FL",
-    "RUN2_PK_FL",
-    "RUN3_PK_FL",
-    "RUN1_RESP_PIT_ID",
-    "RUN2_RESP_PIT_ID",
-    "RUN3_RESP_PIT_ID",
-    "HOME_TEAM_ID",
-    "BAT_TEAM_ID",
-    "FLD_TEAM_ID",
-    "PA_TRUNC_FL",
-    "START_BASES_CD",
-    "END_BASES_CD",
-    "RESP_BAT_START_FL",
-    "RESP_PIT_START_FL",
-    "PA_BALL_CT",
-    "PA_OTHER_BALL_CT",
-    "PA_STRIKE_CT",
-    "PA_OTHER_STRIKE_CT",
-    "EVENT_RUNS_CT",
-    "BAT_SAFE_ERR_FL",
-    "FATE_RUNS_CT",
-    "MLB_STATSAPI_APPROX",
-    "mlbam_id",
-    "0-0",
-    "0-1",
-    "0-2",
-    "1-0",
-    "1-1",
-    "1-2",
-    "2-0",
-    "2-1",
-    "2-2",
-    "3-0",
-    "3-1",
-    "3-2",
-    "PA",
-    "AB",
-    "SH",
-    "SF",
-    "R",
-    "RBI",
-    "SB",
-    "CS",
-    "K",
-    "BK",
-    "UBB",
-    "IBB",
-    "HBP",
-    "FC",
-    "1B",
-    "2B",
-    "3B",
-    "HR",
-    "H",
-    "DP",
-    "TP",
-    "ROE",
-    "WP",
-    "P",
-    "GB",
-    "FB",
-    "LD",
-    "PU",
-    "ER",
-    "T_UER",
-    "UER",
-
-    # Not actual columns, but the API allows filtering by these through backend logic
-    "SCORE",
-    "SCORE_DIFF",
-]
+# The column the minimum filter applies to for each stat type
+min_cols = {
+    "batting": "PA",
+    "pitching": "IP",
+}
+
+# The columns that identify a row, of which each split and find has some
+row_id_cols = ["player_id", "team", "year", "month", "day", "game_id", "start_year", "end_year"]
 
 def proc_params(params, splits: baseballquery.stat_splits.StatSplits):
     method_map = {
@@ -205,189 +78,6 @@ def proc_params(params, splits: baseballquery.stat_splits.StatSplits):
             })
         splits.filter_stats_by_innings(params["filter_home"], stat_filters_list, params["filter_opposing"])
 
-def param_validation(query_params):
-    if "start_year" in query_params and "end_year" in query_params:
-        try:
-            start_year = int(query_params["start_year"])
-            end_year = int(query_params["end_year"])
-        except ValueError:
-            raise ValidationError("start_year and end_year must be integers")
-        if start_year > end_year:
-            raise ValidationError("start_year cannot be greater than end_year")
-    elif "start_year" in query_params and "end_year" not in query_params:
-        raise ValidationError("end_year must be provided if start_year is provided")
-    elif "end_year" in query_params and "start_year" not in query_params:
-        raise ValidationError("start_year must be provided if end_year is provided")
-
-    if "split" in query_params and query_params["split"] not in ["year", "career", "month", "game"]:
-        raise ValidationError("split must be either 'year', 'career', 'month', or 'game'")
-
-    if "find" in query_params and query_params["find"] not in ["player", "team"]:
-        raise ValidationError("find must be either 'player' or 'team'")
-
-    if "days_of_week" in query_params:
-        days_of_week = query_params["days_of_week"].split(",")
-        valid_days = {"Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"}
-        if not all(day in valid_days for day in days_of_week):
-            raise ValidationError(f"days_of_week must be one or more of {', '.join(valid_days)}")
-
-    if "batter_handedness_pa" in query_params and query_params["batter_handedness_pa"] not in ["L", "R"]:
-        raise ValidationError("batter_handedness_pa must be 'L', or 'R'")
-
-    if "pitcher_handedness" in query_params and query_params["pitcher_handedness"] not in ["L", "R"]:
-        raise ValidationError("pitcher_handedness must be 'L', or 'R'")
-
-    if "batter_starter" in query_params and query_params["batter_starter"] not in ["Y", "N"]:
-        raise ValidationError("batter_starter must be 'Y' or 'N'")
-
-    if "pitcher_starter" in query_params and query_params["pitcher_starter"] not in ["Y", "N"]:
-        raise ValidationError("pitcher_starter must be 'Y' or 'N'")
-
-    if "batter_lineup_pos" in query_params:
-        batter_lineup_pos = query_params["batter_lineup_pos"].split(",")
-        if not all(pos.isdigit() and 1 <= int(pos) <= 9 for pos in batter_lineup_pos):
-            raise ValidationError("batter_lineup_pos must be a comma-separated list of integers from 1 to 9")
-
-    if "player_field_position" in query_params:
-        player_field_position = query_params["player_field_position"].split(",")
-        if not all(pos.isdigit() and 1 <= int(pos) <= 12 for pos in player_field_position):
-            raise ValidationError("player_field_position must be a comma-separated list of integers from 1 to 12")
-
-    if "batter_home" in query_params and query_params["batter_home"] not in ["Y", "N"]:
-        raise ValidationError("batter_home must be 'Y' or 'N'")
-
-    if "pitcher_home" in query_params and query_params["pitcher_home"] not in ["Y", "N"]:
-        raise ValidationError("pitcher_home must be 'Y' or 'N'")
-
-    if "pitching_team" in query_params:
-        teams = query_params["pitching_team"].split(",")
-        if not all(team.isupper() and team.isalpha() and len(team) == 3 for team in teams):
-            raise ValidationError("pitching_team must be a comma-separated list of 3-letter uppercase team codes")
-
-    if "batting_team" in query_params:
-        teams = query_params["batting_team"].split(",")
-        if not all(team.isupper() and team.isalpha() and len(team) == 3 for team in teams):
-            raise ValidationError("batting_team must be a comma-separated list of 3-letter uppercase team codes")
-
-    if "innings" in query_params:
-        innings = query_params["innings"].split(",")
-        try:
-            innings = [int(i) for i in innings]
-            if not all(1 <= i for i in innings):
-                raise ValidationError("innings must be a comma-separated list of integers greater than or equal to 1")
-        except ValueError:
-            raise ValidationError("innings must be a comma-separated list of integers")
-
-    if "outs" in query_params:
-        outs = query_params["outs"].split(",")
-        try:
-            outs = [int(o) for o in outs]
-            if not all(0 <= o < 3 for o in outs):
-                raise ValidationError("outs must be a comma-separated list of integers from 0 to 2")
-        except ValueError:
-            raise ValidationError("outs must be a comma-separated list of integers")
-
-    if "count" in query_params:
-        counts = query_params["count"].split(",")
-        if not all(len(count) == 3 and count[0].isdigit() and count[1] == '-' and count[2].isdigit() for count in counts):
-            raise ValidationError("count must be a comma-separated list of strings in the format 'strikes-balls' (e.g., '2-1')")
-        if not all(0 <= int(count.split('-')[0]) <= 2 and 0 <= int(count.split('-')[1]) <= 3 for count in counts):
-            raise ValidationError("strikes must be between 0 and 2, and balls must be between 0 and 3 in the count format 'strikes-balls' (e.g., '2-1')")
-
-    if "strikes" in query_params:
-        strikes = query_params["strikes"].split(",")
-        try:
-            strikes = [int(s) for s in strikes]
-            if not all(0 <= s <= 3 for s in strikes):
-                raise ValidationError("strikes must be a comma-separated list of integers from 0 to 3")
-        except ValueError:
-            raise ValidationError("strikes must be a comma-separated list of integers")
-
-    if "balls" in query_params:
-        balls = query_params["balls"].split(",")
-        try:
-            balls = [int(b) for b in balls]
-            if not all(0 <= b <= 4 for b in balls):
-                raise ValidationError("balls must be a comma-separated list of integers from 0 to 4")
-        except ValueError:
-            raise ValidationError("balls must be a comma-separated list of integers")
-
-    if "score_diff" in query_params:
-        score_diff = query_params["score_diff"].split(",")
-        try:
-            score_diff = [int(sd) for sd in score_diff]
-        except ValueError:
-            raise ValidationError("score_diff must be a comma-separated list of integers")
-
-    if "home_score" in query_params:
-        home_score = query_params["home_score"].split(",")
-        try:
-            home_score = [int(hs) for hs in home_score]
-            if not all(hs >= 0 for hs in home_score):
-                raise ValidationError("home_score must be a comma-separated list of non-negative integers")
-        except ValueError:
-            raise ValidationError("home_score must be a comma-separated list of integers")
-
-    if "away_score" in query_params:
-        away_score = query_params["away_score"].split(",")
-        try:
-            away_score = [int(as_) for as_ in away_score]
-            if not all(as_ >= 0 for as_ in away_score):
-                raise ValidationError("away_score must be a comma-separated list of non-negative integers")
-        except ValueError:
-            raise ValidationError("away_score must be a comma-separated list of integers")
-
-    if "base_situation" in query_params:
-        base_situation = query_params["base_situation"].split(",")
-        try:
-            base_situation = [int(bs) for bs in base_situation]
-            if not all(0 <= bs <= 7 for bs in base_situation):
-                raise ValidationError("base_situation must be a comma-separated list of integers from 0 to 7")
-        except ValueError:
-            raise ValidationError("base_situation must be a comma-separated list of integers")
-
-    if any(x in query_params for x in filter_params) and not all(x in query_params for x in filter_params):
-        raise ValidationError("The filter feature requires all of filter_opposing, filter_innings, filter_top, filter_stats, filter_values, and filter_operators to be specified")
-
-    if "filter_home" in query_params and query_params["filter_home"] not in ["home", "away", "either"]:
-        raise ValidationError("filter_home must be 'home', 'away', or 'either'")
-
-    if "filter_opposing" in query_params and query_params["filter_opposing"] not in ["Y", "N"]:
-        raise ValidationError("filter_opposing must be 'Y' or 'N'")
-
-    if "filter_innings" in query_params:
-        innings = query_params["filter_innings"].split(",")
-        try:
-            innings = [int(i) for i in innings]
-            if not all(1 <= i for i in innings):
-                raise ValidationError("filter_innings must be a comma-separated list of integers greater than or equal to 1")
-        except ValueError:
-            raise ValidationError("filter_innings must be a comma-separated list of integers")
-
-    if "filter_top" in query_params:
-        top = query_params["filter_top"].split(",")
-        if not all(t in ["Y", "N"] for t in top):
-            raise ValidationError("filter_top must be a comma-separated list of 'Y' or 'N' values")
-
-    if "filter_stats" in query_params:
-        cols = query_params["filter_stats"].split(",")
-        if not all(col in valid_filter_cols for col in cols):
-            raise ValidationError(f"filter_stats must be a comma-separated list of valid columns: {', '.join(valid_filter_cols)}")
-
-    if "filter_values" in query_params:
-        values = query_params["filter_values"].split(",")
-        try:
-            values = [int(value) for value in values]
-        except ValueError:
-            raise ValidationError("filter_values must be a comma-separated list of integers")
-
-    if "filter_operators" in query_params:
-        operators = query_params["filter_operators"].split(",")
-        valid_operators = ["=", "<", ">", "<=", ">=", "!="]
-        if not all(op in valid_operators for op in operators):
-            raise ValidationError(f"filter_operators must be a comma-separated list of valid operators: {', '.join(valid_operators)}")
-
-
 def separate_years_into_ranges(years_set):
     """
     Separates a set of years into a list of year ranges.
@@ -417,174 +107,271 @@ def separate_years_into_ranges(years_set):
     ranges.append((current_range_start, current_range_end))  # Add the last range
     return ranges
 
-class BattingStatQuery(APIView):
+def filter_and_sort(chunks, presorted, min_col, min_value, sort):
+    """
+    Applies the minimum PA/IP filter to each list of rows and sorts the result.
+
+    Args:
+        chunks: Lists of stat rows, one per cache entry or freshly computed range of years.
+        presorted: For each chunk, whether it is already in the requested order.
+        min_col: The column the minimum applies to.
+        min_value: Rows with min_col below this are dropped.
+        sort: The sort string.
+
+    Returns:
+        A sequence of the remaining rows in sorted order.
+    """
+    filtered = [([x for x in chunk if x[min_col] is not None and x[min_col] >= min_value], chunk_presorted) for chunk, chunk_presorted in zip(chunks, presorted)]
+    filtered = [(chunk, chunk_presorted) for chunk, chunk_presorted in filtered if chunk]
+    if not filtered:
+        return []
+    return sort_chunks([chunk for chunk, _ in filtered], [chunk_presorted for _, chunk_presorted in filtered], sort)
+
+def calculate_stats(params, start_year, end_year):
+    dataset.check_dataset()
+    s = stat_splits_classes[params["type"]](start_year=start_year, end_year=end_year)
+    proc_params(params, s)
+    s.calculate_stats()
+    s.stats.replace([np.inf, -np.inf], np.nan, inplace=True)
+    s.stats.reset_index(inplace=True, drop=False)
+    # Missing values stay NaN, the sentinel strings are only filled in when rows are sent
+    return s.stats
+
+def scope_stats(stats, scope):
+    if scope is None:
+        return stats
+    column, value = scope
+    if column not in stats:
+        return stats.iloc[:0]
+    return stats[stats[column] == value]
+
+def get_stats(query, admit=True):
+    """
+    Gets the stats for a query from the cache, computing and caching whatever is missing.
+
+    Args:
+        query: The Query, from parse_query.
+        admit: Whether computing missing stats goes through admission control. Offline jobs pass False.
+
+    Returns:
+        A sequence of the stat rows in sorted order.
+    """
+    params = query.params
+    cache = get_query_cache()
+    # Stats are only cached if the data versions did not change while they were computed, since they could be from
+    # either dataset
+    versions = get_year_versions(params["start_year"], params["end_year"])
+
+    def put_data(stats, years):
+        if get_year_versions(params["start_year"], params["end_year"]) == versions:
+            cache.put_data(params, stats, years, versions)
+
+    # Search the cache for data
+    chunks, presorted, years_found = cache.get_chunks(params, query.sort, query.scope)
+    all_years = set(range(params["start_year"], params["end_year"] + 1))
+    missing_years = all_years - years_found
+    ranges_missing_years = separate_years_into_ranges(missing_years)
+    # If we would have to run 3 or more queries to complete this, just rerun the full query
+    rerun_all = len(ranges_missing_years) >= 3 or len(missing_years) == 1 and len(ranges_missing_years) == 2
+    if len(missing_years) > 0:
+        # Cache hits never reach this point, so only cold queries are subject to admission control
+        cost = admission.estimate_cost(params, all_years if rerun_all else missing_years)
+        with admission.controller.admit(cost) if admit else nullcontext():
+            if rerun_all:
+                stats = calculate_stats(params, params["start_year"], params["end_year"])
+                put_data(stats, all_years - years_found)
+                chunks, presorted = [to_records(scope_stats(stats, query.scope))], [False]
+            else:
+                # Otherwise, see what years are missing for this query and calculate those
+                for start_year, end_year in ranges_missing_years:
+                    stats = calculate_stats(params, start_year, end_year)
+                    chunks.append(to_records(scope_stats(stats, query.scope)))
+                    presorted.append(False)
+                    put_data(stats, set(range(start_year, end_year + 1)))
+
+    # Filter and sort the stats based on query parameters
+    return filter_and_sort(chunks, presorted, min_cols[query.type], query.min_value, query.sort)
+
+def row_id(row):
+    return tuple(row.get(col) for col in row_id_cols)
+
+def diff_rows(old_rows, new_rows):
+    """
+    Compares the rows of a query computed from two data versions.
+
+    Args:
+        old_rows: The rows computed from the older data.
+        new_rows: The rows computed from the current data, in the order they are returned.
+
+    Returns:
+        A tuple of the rows that were added, the rows that changed, and the identifying columns of the rows that
+        were removed.
+    """
+    old_by_id = {row_id(row): row for row in old_rows}
+    new_ids = set()
+    added = []
+    changed = []
+    for row in new_rows:
+        new_ids.add(row_id(row))
+        old_row = old_by_id.get(row_id(row))
+        if old_row is None:
+            added.append(row)
+        elif old_row != row:
+            changed.append(row)
+    removed = [{col: row[col] for col in row_id_cols if col in row} for key, row in old_by_id.items() if key not in new_ids]
+    return added, changed, removed
+
+def get_delta(query):
+    """
+    Gets how the stats for a query changed since the data versions of query.since_version.
+
+    Only the cache entries of the years whose data changed are read, and nothing is computed for the older versions:
+    update_new_data.py keeps the entries of the previous version of a year when it gets new data.
+
+    Args:
+        query: The Query, with since_version.
+
+    Returns:
+        A tuple of the added rows, changed rows and removed row ids from diff_rows, or None if the stats of the older
+        versions are no longer cached.
+    """
+    cache = get_query_cache()
+    rows = cache.get_changed_rows(query.params, query.since_versions)
+    if rows is None:
+        # The stats of the current versions may not have been computed yet
+        get_stats(query)
+        rows = cache.get_changed_rows(query.params, query.since_versions)
+        if rows is None:
+            return None
+    if query.scope is not None:
+        column, value = query.scope
+        rows = [[row for row in version_rows if row.get(column) == value] for version_rows in rows]
+    old_rows, new_rows = [filter_and_sort([version_rows], [False], min_cols[query.type], query.min_value, query.sort) for version_rows in rows]
+    return diff_rows(old_rows, new_rows)
+
+def stat_etag(query, page, page_size):
+    """
+    Computes the ETag of a stat response, which only changes when the data of one of the years it covers changes.
+
+    Args:
+        query: The Query.
+        page: The requested page.
+        page_size: The requested page size.
+
+    Returns:
+        The quoted ETag.
+    """
+    year_versions = get_year_versions(query.params["start_year"], query.params["end_year"])
+    key = json.encode([query.key.hex(), str(page), str(page_size), sorted(year_versions.items()), query.since_version], order="deterministic")
+    return f'"{sha1(key).hexdigest()}"'
+
+def cache_control(query):
+    # Past seasons never change, so those responses can be cached for a long time. Queries without years are for the
+    # latest season, which becomes a new one when its first games are ingested.
+    if query.start_year is not None and query.end_year < datetime.now().year:
+        return f"public, max-age={settings.HISTORICAL_MAX_AGE}"
+    return f"public, max-age={settings.CURRENT_SEASON_MAX_AGE}"
+
+class StatQuery(APIView):
+    stat_type = ""
+
+    def dispatch(self, request, *args, **kwargs):
+        if not profiling.should_profile(request):
+            return super().dispatch(request, *args, **kwargs)
+        # Profiles are keyed by the query, so profiling the same query again replaces the older profile
+        try:
+            key = parse_query(request.GET, self.stat_type).key.hex()
+        except ValidationError:
+            key = sha1(request.GET.urlencode().encode()).hexdigest()
+        info = {"path": request.path, "query": request.GET.urlencode()}
+        response, profiled = profiling.profile_call(key, info, super().dispatch, request, *args, **kwargs)
+        if profiled:
+            response["X-Profile-Key"] = key
+        return response
+
     def get(self, request):
-        cache = QueryCache()
-        param_validation(request.query_params)
-        params = {
-            "type": "batting",
-            "start_year": int(request.query_params.get("start_year", 2025)),
-            "end_year": int(request.query_params.get("end_year", 2025)),
-            "split": request.query_params.get("split", "year"),
-            "find": request.query_params.get("find", "player"),
-            **{k: v for k, v in request.query_params.items() if k in split_params},
-            **{k: [list_params_type_func[k](elem) for elem in val.split(",")] for k, val in request.query_params.items() if k in list_params_type_func}
-        }
-
-        for key, value in params.items():
-            if type(value) is list:
-                params[key] = sorted(value)
-
-        # Process boolean params
-        for key in bool_params:
-            if key in params:
-                if params[key] in ["Y", "N"]:
-                    params[key] = True if params[key] == "Y" else False
-
-        # Process filter_top boolean values
-        if "filter_top" in params:
-            params["filter_top"] = [True if val == "Y" else False for val in params["filter_top"]]
-
-            # Make sure all filter_params lists are the same length
-            for param in filter_params:
-                if param in params and (param != "filter_opposing" and len(params[param]) != len(params["filter_top"])):
-                    raise ValidationError(f"All filter parameters must have the same number of elements. '{param}' has {len(params[param])} elements, but 'filter_top' has {len(params['filter_top'])} elements.")
-
-        # Initialize cache and search for data
-        stats, years_found = cache.get_data(params)
-        all_years = set(range(params["start_year"], params["end_year"] + 1))
-        missing_years = all_years - years_found
-        ranges_missing_years = separate_years_into_ranges(missing_years)
-        if len(ranges_missing_years) >= 3 or len(missing_years) == 1 and len(ranges_missing_years) == 2: # If we would have to run 3 or more queries to complete this, just rerun the full query
-            s = baseballquery.BattingStatSplits(start_year=params["start_year"], end_year=params["end_year"])
-            proc_params(params, s)
-            s.calculate_stats()
-            s.stats.replace([np.inf, -np.inf], np.nan, inplace=True)
-            s.stats.reset_index(inplace=True, drop=False)
-            for col in nullable_cols:
-                s.stats[col] = s.stats[col].fillna("N/A")
-            s.stats = s.stats.fillna("NaN")
-            cache.put_data(params, s.stats, years_found)
-            stats = s.stats.to_dict(orient='records', index=True)
-        elif len(ranges_missing_years) > 0:
-            # Otherwise, see what years are missing for this query and calculate those
-            for start_year, end_year in ranges_missing_years:
-                s = baseballquery.BattingStatSplits(start_year=start_year, end_year=end_year)
-                proc_params(params, s)
-                s.calculate_stats()
-                s.stats.replace([np.inf, -np.inf], np.nan, inplace=True)
-                s.stats.reset_index(inplace=True, drop=False)
-                for col in nullable_cols:
-                    s.stats[col] = s.stats[col].fillna("N/A")
-                s.stats = s.stats.fillna("NaN")
-                stats.extend(s.stats.to_dict(orient='records', index=True))
-                cache.put_data(params, s.stats, years_found)
-        cache.close()
-
-        # Filter and sort the stats based on query parameters
-        if len(stats) != 0:
-            min_pa = request.query_params.get("min_pa", 0)
-            stats = list(filter(lambda x: x["PA"] >= int(min_pa), stats))
-            sort = request.query_params.get("sort", "year,player_id")
-            fields = sort.split(",")
-            if fields:
-                for field in reversed(fields):
-                    if field.lstrip("-") not in stats[0]:
-                        raise ValueError(f"Field '{field}' not found in stats")
-                    # Sort the stats based on the fields
-                    negative = field.startswith("-")
-                    field = field.lstrip("-")
-                    field_is_numeric = field not in ["player_id", "team", "game_id"]
-                    stats.sort(key=lambda x: x[field] if (type(x[field]) in (int, float) and field_is_numeric) or not field_is_numeric else (float("-inf") if negative else float("inf")), reverse=negative)
-
-        paginator = PageNumberPagination()
-        paginator.page_size = request.query_params.get("page_size", 50)
-        page = paginator.paginate_queryset(stats, request, view=self)
-        return paginator.get_paginated_response(page)
-
-
-class PitchingStatQuery(APIView):
+        query = parse_query(request.query_params, self.stat_type)
+
+        # Conditional requests are answered before reading anything from the cache
+        etag = stat_etag(query, request.query_params.get("page", 1), request.query_params.get("page_size", 50))
+        version = version_token(get_year_versions(query.params["start_year"], query.params["end_year"]))
+        # Clients send the data version back as since_version to only get what changed
+        headers = {"ETag": etag, "Cache-Control": cache_control(query), "X-Data-Version": version}
+        # If-None-Match uses the weak comparison, and compressed responses are sent with a weak ETag
+        if etag in [tag.removeprefix("W/") for tag in parse_etags(request.headers.get("If-None-Match", ""))]:
+            return HttpResponseNotModified(headers=headers)
+
+        if query.since_version is not None:
+            response = self.delta_response(query, version)
+        else:
+            response = leaderboards.materialized_response(request, query)
+        if response is None:
+            stats = get_stats(query)
+            paginator = PageNumberPagination()
+            paginator.page_size = request.query_params.get("page_size", 50)
+            page = paginator.paginate_queryset(stats, request, view=self)
+            response = paginator.get_paginated_response(fill_sentinels(page))
+        for key, value in headers.items():
+            response[key] = value
+        return response
+
+    def delta_response(self, query, version):
+        """
+        Responds to a since_version request with the rows that were added or changed and the ids of the rows that
+        were removed, unpaginated. If the stats of the older versions are no longer cached, every row is sent as
+        added and "full" is true, so the client replaces what it has.
+        """
+        delta = get_delta(query)
+        full = delta is None
+        if full:
+            delta = get_stats(query), [], []
+        added, changed, removed = delta
+        return Response({
+            "version": version,
+            "since_version": query.since_version,
+            "full": full,
+            "added": fill_sentinels(added),
+            "changed": fill_sentinels(changed),
+            "removed": fill_sentinels(removed),
+        })
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if isinstance(response, Response):
+            response.render()
+        return compress_response(request, response)
+
+
+class BattingStatQuery(StatQuery):
+    stat_type = "batting"
+
+
+class PitchingStatQuery(StatQuery):
+    stat_type = "pitching"
+
+class CacheStats(APIView):
+    permission_classes = [IsAdminUser]
+
     def get(self, request):
-        param_validation(request.query_params)
-        cache = QueryCache()
-        params = {
-            "type": "pitching",
-            "start_year": int(request.query_params.get("start_year", 2025)),
-            "end_year": int(request.query_params.get("end_year", 2025)),
-            "split": request.query_params.get("split", "year"),
-            "find": request.query_params.get("find", "player"),
-            **{k: v for k, v in request.query_params.items() if k in split_params},
-            **{k: [list_params_type_func[k](elem) for elem in val.split(",")] for k, val in request.query_params.items() if k in list_params_type_func}
-        }
-
-        for key, value in params.items():
-            if type(value) is list:
-                params[key] = sorted(value)
-
-        # Process boolean params
-        for key in bool_params:
-            if key in params:
-                if params[key] in ["Y", "N"]:
-                    params[key] = True if params[key] == "Y" else False
-
-        if "filter_top" in params:
-            params["filter_top"] = [True if val == "Y" else False for val in params["filter_top"]]
-
-            # Make sure all filter_params lists are the same length
-            for param in filter_params:
-                if param in params and (param != "filter_opposing" and len(params[param]) != len(params["filter_top"])):
-                    raise ValidationError(f"All filter parameters must have the same number of elements. '{param}' has {len(params[param])} elements, but 'filter_top' has {len(params['filter_top'])} elements.")
-
-        # Initialize cache and search for data
-        stats, years_found = cache.get_data(params)
-        all_years = set(range(params["start_year"], params["end_year"] + 1))
-        missing_years = all_years - years_found
-        ranges_missing_years = separate_years_into_ranges(missing_years)
-        if len(ranges_missing_years) >= 3 or len(missing_years) == 1 and len(ranges_missing_years) == 2: # If we would have to run 3 or more queries to complete this, just rerun the full query
-            s = baseballquery.PitchingStatSplits(start_year=params["start_year"], end_year=params["end_year"])
-            proc_params(params, s)
-            s.calculate_stats()
-            s.stats.replace([np.inf, -np.inf], np.nan, inplace=True)
-            s.stats.reset_index(inplace=True, drop=False)
-            for col in nullable_cols:
-                s.stats[col] = s.stats[col].fillna("N/A")
-            s.stats = s.stats.fillna("NaN")
-            cache.put_data(params, s.stats, years_found)
-            stats = s.stats.to_dict(orient='records', index=True)
-        elif len(ranges_missing_years) > 0:
-            # Otherwise, see what years are missing for this query and calculate those
-            for start_year, end_year in ranges_missing_years:
-                s = baseballquery.PitchingStatSplits(start_year=start_year, end_year=end_year)
-                proc_params(params, s)
-                s.calculate_stats()
-                s.stats.replace([np.inf, -np.inf], np.nan, inplace=True)
-                s.stats.reset_index(inplace=True, drop=False)
-                for col in nullable_cols:
-                    s.stats[col] = s.stats[col].fillna("N/A")
-                s.stats = s.stats.fillna("NaN")
-                stats.extend(s.stats.to_dict(orient='records', index=True))
-                cache.put_data(params, s.stats, years_found)
-        cache.close()
-
-        if len(stats) != 0:
-            min_ip = request.query_params.get("min_ip", 0)
-            stats = list(filter(lambda x: x["IP"] >= int(min_ip), stats))
-            sort = request.query_params.get("sort", "year,player_id")
-            fields = sort.split(",")
-            if fields:
-                for field in reversed(fields):
-                    if field.lstrip("-") not in stats[0]:
-                        raise ValueError(f"Field '{field}' not found in stats")
-                    # Sort the stats based on the fields
-                    negative = field.startswith("-")
-                    field = field.lstrip("-")
-                    field_is_numeric = field not in ["player_id", "team", "game_id"]
-                    stats.sort(key=lambda x: x[field] if (type(x[field]) in (int, float) and field_is_numeric) or not field_is_numeric else (float("-inf") if negative else float("inf")), reverse=negative)
-
-        paginator = PageNumberPagination()
-        paginator.page_size = request.query_params.get("page_size", 50)
-        page = paginator.paginate_queryset(stats, request, view=self)
-        return paginator.get_paginated_response(page)
+        hot = get_query_cache().hot
+        return Response({"hot_cache": None if hot is None else hot.stats()})
+
+class Profiles(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        key = request.query_params.get("key")
+        if key is None:
+            return Response(profiling.list_profiles())
+        # Not "format", which DRF uses to pick a renderer
+        output = request.query_params.get("output", "text")
+        if output not in ["pstats", "collapsed", "text"]:
+            raise ValidationError("output must be 'pstats', 'collapsed', or 'text'")
+        profile = profiling.read_profile(key, output)
+        if profile is None:
+            raise NotFound("Profile not found.")
+        content_type = "application/octet-stream" if output == "pstats" else "text/plain"
+        return HttpResponse(profile, content_type=content_type)
 
 class SavedQueries(APIView):
     def get(self, request):
@@ -606,26 +393,9 @@ class SavedQueries(APIView):
 
         if "type" not in params:
             raise ValidationError("'type' must be specified in params.")
-        if params["type"] not in ["batting", "pitching"]:
-            raise ValidationError("'type' in params must be either 'batting' or 'pitching'.")
-        # Convert lists to comma separated lists for validation
-        params_new = deepcopy(params)
-        to_delete = []
-        for key, value in params_new.items():
-            if isinstance(value, list):
-                if len(value) == 0:
-                    to_delete.append(key)
-                else:
-                    params_new[key] = ",".join(map(str, value))
-            if value is None or value == "":
-                to_delete.append(key)
-            if isinstance(value, bool):
-                params_new[key] = "Y" if value else "N"
-        for key in to_delete:
-            del params_new[key]
-        param_validation(params_new)
-        
-        
+        # Validated with the same schema as the stat endpoints
+        parse_query(params)
+
         saved_query = SavedQuery(params=params)
         saved_query.save()
         return Response({"message": "Saved query created successfully.", "uuid": str(saved_query.key)}, status=201)
@@ -1,15 +1,166 @@
-import baseballquery
+import os
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "baseballquery_backend.settings")
+django.setup()
+
 import datetime
-from rest_api.cache import QueryCache
-
-data_current_year = baseballquery.utils.get_year_events(datetime.datetime.now().year)
-# Update data and check if any new games from the current year were added
-baseballquery.update_data()
-data_current_year_new = baseballquery.utils.get_year_events(datetime.datetime.now().year)
-
-# If any new rows were added
-if data_current_year_new.shape[0] != data_current_year.shape[0]:
-    # New games were added for the current year
-    print("New games found for the current year, deleting cache for this year")
-    cache = QueryCache()
-    cache.delete_year_data(2025)
\ No newline at end of file
+import fcntl
+import requests
+import shutil
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+from baseballquery.database import engine
+from rest_api.cache import get_query_cache
+from rest_api.leaderboards import materialize_leaderboards
+from rest_api.versions import get_versions, set_year_versions
+
+data_dir = Path("~/.baseballquery").expanduser()
+# Files of the dataset that are replaced when a new one is published, the database last
+dataset_files = ["min_year.txt", "years.txt", "baseballquery.db"]
+# Seconds to wait on the schedule request, which runs while the update lock is held
+schedule_timeout = 30
+
+
+def stage_dataset(staging_home):
+    """
+    Copies the live dataset into staging_home/.baseballquery, where it can be updated without touching the files
+    the workers are reading.
+    """
+    staging_dir = staging_home / ".baseballquery"
+    staging_dir.mkdir(parents=True)
+    for name in dataset_files[:-1]:
+        if (data_dir / name).exists():
+            shutil.copy2(data_dir / name, staging_dir / name)
+    if (data_dir / "baseballquery.db").exists():
+        # The backup API gives a consistent copy even while workers are reading the database
+        source = sqlite3.connect(data_dir / "baseballquery.db")
+        target = sqlite3.connect(staging_dir / "baseballquery.db")
+        with target:
+            source.backup(target)
+        source.close()
+        target.close()
+    return staging_dir
+
+
+def ingest(staging_home):
+    # The library finds its data through HOME when it is imported, so the update runs in its own process
+    subprocess.run([sys.executable, "-c", "import baseballquery; baseballquery.update_data()"], env={**os.environ, "HOME": str(staging_home)}, check=True)
+
+
+def count_events(db):
+    """
+    Counts the events of every season in a dataset, in SQL so no season has to be loaded.
+
+    Returns:
+        A dict of year to number of events.
+    """
+    connection = sqlite3.connect(db)
+    try:
+        return dict(connection.execute("SELECT year, COUNT(*) FROM events GROUP BY year").fetchall())
+    except sqlite3.OperationalError:
+        # The events table does not exist before the first update
+        return {}
+    finally:
+        connection.close()
+
+
+def has_new_games(year):
+    """
+    Checks whether the schedule has finished regular season games of a season that are not in the dataset yet, which
+    is all update_data() adds between releases of the library. Costs one schedule request and an indexed query.
+    """
+    # The same schedule the library ingests from
+    response = requests.get(f"https://statsapi.mlb.com/api/v1/schedule?sportId=1&startDate={year}-01-01&endDate={year}-12-31", timeout=schedule_timeout)
+    response.raise_for_status()
+    finished = {
+        str(game["gamePk"])
+        for date in response.json()["dates"]
+        for game in date["games"]
+        if game["gameType"] == "R" and game["status"]["codedGameState"] == "F"
+    }
+    connection = sqlite3.connect(data_dir / "baseballquery.db")
+    try:
+        ingested = {row[0] for row in connection.execute("SELECT DISTINCT mlbam_id FROM events WHERE year = ?", (year,))}
+    except sqlite3.OperationalError:
+        # The events table does not exist before the first update
+        return True
+    finally:
+        connection.close()
+    return bool(finished - ingested)
+
+
+def publish_dataset(staging_dir):
+    # The staging directory is on the same filesystem, so each rename is atomic and workers either see the old file
+    # or the new one
+    for name in dataset_files:
+        if (staging_dir / name).exists():
+            os.replace(staging_dir / name, data_dir / name)
+
+
+staging_root = data_dir / "staging"
+staging_root.mkdir(parents=True, exist_ok=True)
+# The cron job and a container start can overlap, only one of them ingests
+lock = open(staging_root / ".lock", "w")
+try:
+    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+except BlockingIOError:
+    print("Another update is already running")
+    sys.exit(0)
+
+current_year = datetime.datetime.now().year
+# Container starts pass --full, since a new version of the library can add whole seasons. The cron runs only stage a
+# copy of the dataset when there are new games to ingest.
+if "--full" not in sys.argv:
+    try:
+        new_games = has_new_games(current_year)
+    except requests.RequestException as e:
+        # The next cron run checks again
+        print(f"Could not check the schedule for new games: {e}")
+        sys.exit(1)
+    if not new_games:
+        print("No new games to ingest")
+        sys.exit(0)
+
+events_before = count_events(data_dir / "baseballquery.db")
+previous_versions = get_versions()
+
+staging_home = staging_root / datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+try:
+    print("Staging a copy of the dataset")
+    staging_dir = stage_dataset(staging_home)
+    ingest(staging_home)
+    events_after = count_events(staging_dir / "baseballquery.db")
+    # Usually only the current season gets new games, but a new version of the library can replace a past season,
+    # e.g. a StatsAPI approximated one with the Retrosheet data
+    changed_years = {year: events for year, events in events_after.items() if events != events_before.get(year)}
+    print("Publishing the new dataset")
+    publish_dataset(staging_dir)
+    if changed_years:
+        # Written right after the data is published, so stats computed from the new data are not cached as the
+        # previous version. Workers check for a new dataset as soon as they see the new versions.
+        set_year_versions(changed_years)
+finally:
+    shutil.rmtree(staging_home, ignore_errors=True)
+
+# Connections opened before the dataset was published still read the old file
+engine.dispose()
+
+if changed_years:
+    cache = get_query_cache()
+    for year, events in sorted(changed_years.items()):
+        print(f"The data of {year} changed, deleting its cached stats")
+        previous_version = previous_versions.get(year, 0)
+        # The stats of the previous version are kept so since_version requests can be answered with what changed.
+        # A season that was replaced with fewer events could reuse the key of an older version, so it is cleared.
+        cache.delete_year_data(year, before_version=previous_version if events > previous_version else None)
+    # Stop serving the old leaderboards while they are recomputed
+    cache.put_pages({})
+
+print("Materializing leaderboards")
+print(f"Materialized {materialize_leaderboards()} leaderboard pages")
+
+# Wait for any writes to the shared cache tier to finish
+get_query_cache().close()